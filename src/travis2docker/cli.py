@@ -13,34 +13,81 @@ Why does this file exist, and why not put this in __main__?
 
 """
 
-import argparse
+import contextlib
+import hashlib
+import json
 import os
-from os.path import expanduser, expandvars, isdir, isfile, join
+import sys
+import time
+from os.path import dirname, expanduser, expandvars, isdir, isfile, join, realpath
 from sys import stdout
 
 from . import __version__
 from .exceptions import InvalidRepoBranchError
 from .git_run import GitRun
-from .travis2docker import Travis2Docker
 
+# argparse, jinja2 (travis2docker module) and yaml are imported only in the commands using them,
+# the cli is called many times by other scripts and e.g. --version should not wait to load them
 
-def get_git_data(project, path, revision):
-    git_obj = GitRun(project, path, path_prefix_repo=True)
-    git_obj.update()
+
+def read_git_data(git_obj, revision, bundle_path=None):
+    """:param bundle_path str: Export the revision as a git bundle to this path"""
+    files = git_obj.show_files([".travis.yml", ".t2d.yml", "variables.sh"], revision)
+    content_fname = ".travis.yml" if files[".travis.yml"] else ".t2d.yml"
     data = {
         "sha": git_obj.get_sha(revision),
-        "content": git_obj.show_file(".travis.yml", revision) or git_obj.show_file(".t2d.yml", revision),
-        "variables_sh": git_obj.show_file("variables.sh", revision),
+        "content": files[content_fname],
+        # The sha of the blob is used to parse only once the same yml of many revisions
+        "content_sha": files[content_fname] and git_obj.get_sha("%s:%s" % (revision, content_fname)),
+        "variables_sh": files["variables.sh"],
         "repo_owner": git_obj.owner,
         "repo_project": git_obj.repo,
         "git_email": git_obj.get_config_data("user.email"),
         "git_user": git_obj.get_config_data("user.name"),
         "revision": revision,
-        "project": project,
+        "project": git_obj.repo_git,
     }
+    if bundle_path:
+        source_bundle_ref = git_obj.create_bundle(revision, bundle_path)
+        if source_bundle_ref:
+            data.update({"source_bundle_path": bundle_path, "source_bundle_ref": source_bundle_ref})
     return data
 
 
+def get_bundle_path(root_path, git_repo, revision):
+    return join(root_path, "bundle", GitRun.url2dirname(git_repo), revision, "source.bundle")
+
+
+def get_git_data(
+    project,
+    path,
+    revision,
+    full_fetch=False,
+    partial_clone=None,
+    max_age=None,
+    offline=False,
+    shared_objects=False,
+    bundle_path=None,
+):
+    git_obj = GitRun(
+        project,
+        path,
+        path_prefix_repo=True,
+        partial_clone=partial_clone,
+        offline=offline,
+        shared_objects=shared_objects,
+    )
+    if not offline:
+        git_obj.update(None if full_fetch else revision, max_age=max_age)
+    elif not git_obj.get_sha(revision):
+        raise InvalidRepoBranchError(
+            "The revision %s of %s is not in the local mirror %s. "
+            "Run it without --offline to fetch it." % (revision, project, git_obj.path)
+        )
+    with git_obj.lock(shared=True), git_obj:
+        return read_git_data(git_obj, revision, bundle_path=bundle_path)
+
+
 def yml_read(yml_path):
     yml_path_expanded = expandvars(expanduser(yml_path))
     alt_yml_path_expanded = None
@@ -56,8 +103,205 @@ def yml_read(yml_path):
         return f_yml.read()
 
 
+def get_default_root_path():
+    default_root_path = os.environ.get("TRAVIS2DOCKER_ROOT_PATH")
+    if not default_root_path:
+        default_root_path = os.path.expanduser("~")
+    return join(default_root_path, ".t2d")
+
+
+def main_maintenance(return_result=False):
+    """Repack the mirrors of the repositories, to run it from a scheduled job"""
+    import argparse  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(prog="travisfile2dockerfile maintenance", description=main_maintenance.__doc__)
+    parser.add_argument(
+        "git_repo_urls",
+        nargs="*",
+        help="Repositories git to repack. Default: All the mirrors of the root path",
+    )
+    default_root_path = get_default_root_path()
+    parser.add_argument(
+        "--root-path",
+        dest="root_path",
+        help=f"Root path of the mirrors.\nDefault: {default_root_path}",
+        default=default_root_path,
+    )
+    parser.add_argument(
+        "--force",
+        dest="force",
+        action="store_true",
+        default=False,
+        help="Run `git gc` even if `git gc --auto` thinks that it is not needed",
+    )
+    args = parser.parse_args(sys.argv[2:])
+    repo_path = join(args.root_path, "repo")
+    if args.git_repo_urls:
+        git_objs = [GitRun(git_repo, repo_path, path_prefix_repo=True) for git_repo in args.git_repo_urls]
+    else:
+        git_objs = [
+            GitRun(fname, join(repo_path, fname))
+            for fname in sorted(os.listdir(repo_path) if isdir(repo_path) else [])
+            if isdir(join(repo_path, fname, "refs"))
+        ]
+    repacked = []
+    for git_obj in git_objs:
+        if git_obj.maintenance(auto=not args.force) is not None:
+            repacked.append(git_obj.path)
+    stdout.write("\nMaintenance done for %d mirrors\n" % len(repacked))
+    if return_result:
+        return repacked
+
+
+def warm_mirror(git_repo, repo_path, max_age=None, partial_clone=None, shared_objects=False):
+    start = time.time()
+    res = {"status": "ok", "bytes": 0, "refs": 0, "error": None}
+    try:
+        git_obj = GitRun(
+            git_repo, repo_path, path_prefix_repo=True, partial_clone=partial_clone, shared_objects=shared_objects
+        )
+        stats = git_obj.update(max_age=max_age)
+        res.update({"bytes": stats["bytes"], "refs": stats["refs"]})
+        if not stats["fetched"]:
+            res.update({"status": "failed", "error": "The fetch of the branches failed"})
+    except Exception as error:  # pylint: disable=broad-except
+        res.update({"status": "failed", "error": error})
+    res["seconds"] = time.time() - start
+    return res
+
+
+def main_warm(return_result=False):
+    """Create or update the mirrors of many repositories concurrently"""
+    import argparse  # pylint: disable=import-outside-toplevel
+    import concurrent.futures  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(prog="travisfile2dockerfile warm", description=main_warm.__doc__)
+    parser.add_argument(
+        "repos_file",
+        nargs="?",
+        default="-",
+        help="File with a repository git url by line. Default: Read them from stdin",
+    )
+    default_root_path = get_default_root_path()
+    parser.add_argument(
+        "--root-path",
+        dest="root_path",
+        help=f"Root path of the mirrors.\nDefault: {default_root_path}",
+        default=default_root_path,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type=int,
+        default=8,
+        help="Number of repositories updated at the same time. Default: 8",
+    )
+    parser.add_argument(
+        "--max-age",
+        dest="max_age",
+        type=int,
+        default=None,
+        help="Skip the repositories fetched less than MAX_AGE seconds ago",
+    )
+    parser.add_argument(
+        "--partial-clone",
+        dest="partial_clone",
+        nargs="?",
+        const="tree:0",
+        default=None,
+        help="Create the new mirrors as partial clones. See the same option of travis2docker",
+    )
+    parser.add_argument(
+        "--shared-objects",
+        dest="shared_objects",
+        action="store_true",
+        default=False,
+        help="Share the git objects of the forks. See the same option of travis2docker",
+    )
+    args = parser.parse_args(sys.argv[2:])
+    if args.repos_file == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(expandvars(expanduser(args.repos_file))) as f_repos:
+            lines = f_repos.read().splitlines()
+    git_repos = []
+    for line in lines:
+        line = line.split("#", 1)[0].strip()
+        if line and line not in git_repos:
+            git_repos.append(line)
+
+    summary = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+        futures = {
+            executor.submit(
+                warm_mirror,
+                git_repo,
+                join(args.root_path, "repo"),
+                max_age=args.max_age,
+                partial_clone=args.partial_clone,
+                shared_objects=args.shared_objects,
+            ): git_repo
+            for git_repo in git_repos
+        }
+        # Report each one when it finishes, a slow remote does not stall the rest
+        for future in concurrent.futures.as_completed(futures):
+            res = summary[futures[future]] = future.result()
+            error = ": %s" % res["error"] if res["error"] else ""
+            stdout.write(
+                "%-6s %7.2fs %10d bytes %s%s\n" % (res["status"], res["seconds"], res["bytes"], futures[future], error)
+            )
+    failed = [git_repo for git_repo, res in summary.items() if res["status"] == "failed"]
+    stdout.write("\nWarm: %d repositories updated, %d failed\n" % (len(summary) - len(failed), len(failed)))
+    if return_result:
+        return summary
+
+
+def main_diff_layers(return_result=False):
+    """Show the first step of the Dockerfiles of two jobs that can not use the cache of docker of the other"""
+    import argparse  # pylint: disable=import-outside-toplevel
+
+    from .travis2docker import diff_layers  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(prog="travisfile2dockerfile diff-layers", description=main_diff_layers.__doc__)
+    parser.add_argument("work_path_a", help="Path of the scripts generated of a job")
+    parser.add_argument("work_path_b", help="Path of the scripts generated of other job")
+    parser.add_argument("--dockerfile", dest="dockerfile", default="Dockerfile", help="Default: Dockerfile")
+    args = parser.parse_args(sys.argv[2:])
+    diff = diff_layers(args.work_path_a, args.work_path_b, args.dockerfile)
+    if diff is None:
+        stdout.write("All the steps are the same\n")
+    else:
+        reason = "the content of the files copied" if diff["reason"] == "content" else "the instruction"
+        stdout.write(
+            "The first %d steps are the same, the step %d is different by %s:\n- %s\n+ %s\n"
+            % (diff["step"] - 1, diff["step"], reason, diff["a"], diff["b"])
+        )
+    if return_result:
+        return diff
+
+
+SUBCOMMANDS = {
+    "maintenance": main_maintenance,
+    "warm": main_warm,
+    "diff-layers": main_diff_layers,
+}
+
+
 def main(return_result=False):
-    parser = argparse.ArgumentParser()
+    # A repository with the name of a subcommand is used after "--" e.g. travisfile2dockerfile -- warm main
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        return SUBCOMMANDS[sys.argv[1]](return_result=return_result)
+    if sys.argv[1:] in (["--version"], ["-v"]):
+        # Same output than the "version" action of argparse
+        stdout.write("%s %s\n" % (os.path.basename(sys.argv[0]), __version__))
+        sys.exit(0)
+    import argparse  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(
+        epilog="Subcommands: %s. Use `--` before the positional arguments "
+        "for a repository with the name of a subcommand" % ", ".join(SUBCOMMANDS),
+    )
     parser.add_argument(
         "git_repo_url",
         help="Specify repository git of work."
@@ -89,10 +333,7 @@ def main(return_result=False):
         "in .travis.yml"
         "\nDefault: 'vauxoo/odoo-80-image-shippable-auto'",
     )
-    default_root_path = os.environ.get("TRAVIS2DOCKER_ROOT_PATH")
-    if not default_root_path:
-        default_root_path = os.path.expanduser("~")
-    default_root_path = join(default_root_path, ".t2d")
+    default_root_path = get_default_root_path()
     parser.add_argument(
         "--root-path",
         dest="root_path",
@@ -152,6 +393,65 @@ def main(return_result=False):
         help="Avoid clone the repository. It will require travis-yml-path",
         default=False,
     )
+    parser.add_argument(
+        "--full-fetch",
+        dest="full_fetch",
+        action="store_true",
+        help="Fetch all the branches and pull requests of the repository. "
+        "By default only the git revision is fetched",
+        default=False,
+    )
+    parser.add_argument(
+        "--partial-clone",
+        dest="partial_clone",
+        nargs="?",
+        const="tree:0",
+        default=None,
+        help="Create the mirror of the repository as a partial clone without blobs and trees, "
+        "only the files used are fetched on demand. "
+        "Optionally, use a custom filter spec e.g. --partial-clone=blob:none\n"
+        "Note: It is used only the first time the mirror is created",
+    )
+    parser.add_argument(
+        "--fan-out",
+        dest="fan_out",
+        action="store_true",
+        default=False,
+        help="Use git_revision as patterns of branches and pull requests separated by a comma "
+        "e.g. 'pull/*,1[0-9].0' and generate the scripts for all of them. "
+        "The revisions whose sha did not change since the last run are skipped",
+    )
+    parser.add_argument(
+        "--shared-objects",
+        dest="shared_objects",
+        action="store_true",
+        default=False,
+        help="Share the git objects of the forks of the same project e.g. odoo/odoo and Vauxoo/odoo "
+        "instead of a full clone of each one. "
+        "Note: It is used only the first time the mirror is created",
+    )
+    parser.add_argument(
+        "--source-bundle",
+        dest="source_bundle",
+        action="store_true",
+        default=False,
+        help="Export the revision from the local mirror as a git bundle into the build context, "
+        "so the Dockerfile fetches the source from it instead of the network",
+    )
+    parser.add_argument(
+        "--max-age",
+        dest="max_age",
+        type=int,
+        default=None,
+        help="Skip the fetch of the repository if the revision was fetched less than MAX_AGE seconds ago",
+    )
+    parser.add_argument(
+        "--offline",
+        dest="offline",
+        action="store_true",
+        default=False,
+        help="Avoid fetch the repository, the revision is read only from the local mirror",
+    )
     parser.add_argument(
         "--add-rcfile",
         dest="add_rcfile",
@@ -186,6 +486,90 @@ def main(return_result=False):
         default=False,
         help="Use the image generated from the CI and used in deployV",
     )
+    parser.add_argument(
+        "--layered-dockerfile",
+        dest="layered",
+        action="store_true",
+        default=False,
+        help="Order the steps of the Dockerfile to reuse the cache of docker between jobs and revisions: "
+        "the steps of the image, apt and the files copied first, then the clone of the revision, "
+        "then the env and steps of the job. Use 'travis2docker diff-layers' to compare two jobs",
+    )
+    parser.add_argument(
+        "--cache-mounts",
+        dest="cache_mounts",
+        action="store_true",
+        default=False,
+        help="Use the directories of the 'cache' section of the yml as cache mounts of BuildKit "
+        "in the RUN steps of the Dockerfile and as named volumes of the container. "
+        "They are shared by all the builds and containers of the repository. "
+        "The directories of the build directory are copied from and to the cache instead",
+    )
+    parser.add_argument(
+        "--multi-stage",
+        dest="multi_stage",
+        action="store_true",
+        default=False,
+        help="Generate a Dockerfile for each python version with a base stage (image, apt, files copied, "
+        "the clone of the revision, the env and the install steps) shared by the jobs with the same steps "
+        "and a stage for each job with its script. "
+        "The 10-build.sh of each job builds its stage, the common steps are built only once. "
+        "The steps are ordered as --layered-dockerfile",
+    )
+    parser.add_argument(
+        "--dedup-jobs",
+        dest="dedup_jobs",
+        action="store_true",
+        default=False,
+        help="Generate only one build context and image for the jobs with the same Dockerfile and scripts "
+        "e.g. duplicated entries of the matrix, the directories of the other jobs are symlinks to it",
+    )
+    parser.add_argument(
+        "--only-python",
+        dest="only_python",
+        nargs="*",
+        default=[],
+        help="Generate only the jobs of these python versions e.g. 3.8",
+    )
+    parser.add_argument(
+        "--only-env",
+        dest="only_env",
+        nargs="*",
+        type=int,
+        default=[],
+        help="Generate only the jobs of these numbers of env e.g. 2 for env_2_job_*",
+    )
+    parser.add_argument(
+        "--only-job",
+        dest="only_job",
+        nargs="*",
+        type=int,
+        default=[],
+        help="Generate only the jobs of these numbers of jobs.include e.g. 1 for env_*_job_1",
+    )
+    parser.add_argument(
+        "--only",
+        dest="only_vars",
+        nargs="*",
+        default=[],
+        help="Generate only the jobs with the variables of env matching the regex e.g. TESTS=1 'LINT_CHECK=[01]'. "
+        "The names of the jobs generated are the same than generating all of them",
+    )
+    parser.add_argument(
+        "--tar-job",
+        dest="tar_job",
+        help="Write the build context of the job (e.g. 3_8/env_1_job_1 or its number e.g. 1) "
+        "as a tar to the stdout, e.g. to use it with 'docker build -'. "
+        "The scripts are not written in the root path",
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=None,
+        help="Number of processes rendering the jobs of the matrix at the same time, "
+        "the files are written by the main process in the same order. Default: One by one",
+    )
     parser.add_argument(
         "--build-extra-steps",
         nargs="*",
@@ -195,7 +579,173 @@ def main(return_result=False):
     )
 
     args = parser.parse_args()
+    for only_var in args.only_vars:
+        if "=" not in only_var:
+            parser.error("--only uses VARIABLE=REGEX, got %s" % only_var)
+    if args.deployv and args.multi_stage:
+        parser.error("--multi-stage is not supported by the Dockerfile of --deployv")
+    if args.fan_out:
+        if args.no_clone:
+            parser.error("--fan-out requires to clone the repository")
+        if args.tar_job:
+            parser.error("--tar-job is used for only one revision")
+        summary = main_fan_out(args)
+        if return_result:
+            return summary
+        return
+    if args.tar_job:
+        # Only the tar is written in the stdout to use it with a pipe, the messages are written in the stderr
+        tar_stdout = getattr(sys.stdout, "buffer", sys.stdout)
+        with contextlib.redirect_stdout(sys.stderr):
+            plan = get_job_plan(args, args.git_revision, get_os_kwargs(args), args.tar_job)
+        plan.write_tar(tar_stdout)
+        tar_stdout.flush()
+        if return_result:
+            return plan
+        return
+    fname_scripts = generate_scripts(args, args.git_revision, get_os_kwargs(args))
+    if return_result:
+        return fname_scripts
+
+
+def get_os_kwargs(args):
+    """Data of the repository for the templates"""
     revision = args.git_revision
+    git_repo = args.git_repo_url
+    root_path = args.root_path
+    if args.no_clone:
+        os_kwargs = {
+            "repo_owner": "local_file",
+            "repo_project": "local_file",
+            "revision": revision,
+            "sha": "local_file",
+            "project": git_repo,
+        }
+    else:
+        os_kwargs = get_git_data(
+            git_repo,
+            join(root_path, "repo"),
+            revision,
+            full_fetch=args.full_fetch,
+            partial_clone=args.partial_clone,
+            max_age=args.max_age,
+            offline=args.offline,
+            shared_objects=args.shared_objects,
+            bundle_path=args.source_bundle and not args.deployv and get_bundle_path(root_path, git_repo, revision),
+        )
+    return os_kwargs
+
+
+def ref2revision(refname):
+    """Revision name used by the cli for the ref of the mirror e.g. refs/pull/1 -> pull/1"""
+    for prefix in ("refs/heads/", "refs/"):
+        if refname.startswith(prefix):
+            return refname[len(prefix) :]
+    return refname
+
+
+def revision2ref_pattern(revision_pattern):
+    """Pattern of the refs of the mirror for a revision pattern e.g. pull/* -> refs/pull/*"""
+    if revision_pattern.startswith("refs/"):
+        return revision_pattern
+    return GitRun.revision2ref(revision_pattern)
+
+
+def get_options_signature(args):
+    """Signature of what generates the scripts besides the revision
+
+    The options of the cli, the version, the content of the templates and of the --travis-yml-path file
+    """
+    options = {key: value for key, value in vars(args).items() if key != "git_revision"}
+    options["version"] = __version__
+    signature = hashlib.sha1(json.dumps(options, sort_keys=True, default=str).encode("utf-8"))
+    templates_path = join(dirname(realpath(__file__)), "templates")
+    for dirpath, dirnames, fnames in os.walk(templates_path):
+        dirnames.sort()
+        for fname in sorted(fnames):
+            fname_path = join(dirpath, fname)
+            signature.update(os.path.relpath(fname_path, templates_path).encode("utf-8") + b"\0")
+            with open(fname_path, "rb") as f_template:
+                signature.update(f_template.read() + b"\0")
+    if args.travis_yml_path:
+        signature.update((yml_read(args.travis_yml_path) or "").encode("utf-8"))
+    return signature.hexdigest()
+
+
+def main_fan_out(args):
+    """Generate the scripts of all the refs matching the patterns of `git_revision`
+
+    The sha generated for each ref is saved in an index, so the refs
+    that were not changed since the last run are skipped
+    """
+    git_repo = args.git_repo_url
+    root_path = args.root_path
+    git_obj = GitRun(
+        git_repo,
+        join(root_path, "repo"),
+        path_prefix_repo=True,
+        partial_clone=args.partial_clone,
+        offline=args.offline,
+        shared_objects=args.shared_objects,
+    )
+    if not args.offline:
+        git_obj.update(max_age=args.max_age)
+    ref_patterns = [revision2ref_pattern(pattern) for pattern in args.git_revision.split(",") if pattern]
+    script_path = join(root_path, "script", GitRun.url2dirname(git_repo))
+    index_path = join(script_path, "t2d_index.json")
+    index = {}
+    if isfile(index_path):
+        with open(index_path) as f_index:
+            index = json.load(f_index)
+    # The refs are generated again if the options change
+    options = get_options_signature(args)
+
+    with git_obj.lock(shared=True), git_obj:
+        # Read everything at once to release the lock of the mirror before generating
+        refs_data = {}
+        for ref_data in git_obj.iter_ref_data(ref_patterns, ["objectname"]):
+            revision = ref2revision(ref_data.refname)
+            unchanged = index.get(revision) == {"sha": ref_data["objectname"], "options": options}
+            if unchanged and isdir(join(script_path, revision)):
+                refs_data[revision] = None
+                continue
+            bundle_path = args.source_bundle and not args.deployv and get_bundle_path(root_path, git_repo, revision)
+            refs_data[revision] = read_git_data(git_obj, revision, bundle_path=bundle_path)
+
+    summary = {}
+    for revision, os_kwargs in refs_data.items():
+        start = time.time()
+        res = {"status": "skipped", "scripts": [], "error": None}
+        if os_kwargs is not None:
+            try:
+                res["scripts"] = generate_scripts(args, revision, os_kwargs)
+                res["status"] = "generated"
+                index[revision] = {"sha": os_kwargs["sha"], "options": options}
+            except Exception as error:  # pylint: disable=broad-except
+                res.update({"status": "failed", "error": error})
+        res["seconds"] = time.time() - start
+        summary[revision] = res
+    if summary:
+        if not isdir(script_path):
+            os.makedirs(script_path)
+        with open(index_path, "w") as f_index:
+            json.dump(index, f_index, indent=4, sort_keys=True)
+
+    statuses = [res["status"] for res in summary.values()]
+    stdout.write(
+        "\nSummary: %d generated, %d skipped, %d failed\n"
+        % (statuses.count("generated"), statuses.count("skipped"), statuses.count("failed"))
+    )
+    for revision, res in summary.items():
+        error = ": %s" % res["error"] if res["error"] else ""
+        stdout.write("%-9s %7.2fs %s%s\n" % (res["status"], res["seconds"], revision, error))
+    return summary
+
+
+def get_travis2docker(args, revision, os_kwargs):
+    """Travis2Docker object of the revision using the options of the cli and the data of the repository"""
+    from .travis2docker import Travis2Docker  # pylint: disable=import-outside-toplevel
+
     git_repo = args.git_repo_url
     git_base = GitRun.get_data_url(git_repo, False)[0]
     docker_user = args.docker_user
@@ -208,22 +758,11 @@ def main(return_result=False):
     travis_yml_path = args.travis_yml_path
     build_extra_cmds = "\n".join(args.build_extra_cmds)
     run_extra_cmds = "\n".join(args.run_extra_cmds)
-    no_clone = args.no_clone
     deployv = args.deployv
     rcfiles_args = args.add_rcfile and args.add_rcfile.split(",")
     runs_at_the_end_script = args.runs_at_the_end_script or None
     build_env_args = [build_env_args[0] for build_env_args in args.build_env_args]
     rcfiles = [(expanduser(rc_file), os.path.join("$HOME", os.path.basename(rc_file))) for rc_file in rcfiles_args]
-    if no_clone:
-        os_kwargs = {
-            "repo_owner": "local_file",
-            "repo_project": "local_file",
-            "revision": revision,
-            "sha": "local_file",
-            "project": git_repo,
-        }
-    else:
-        os_kwargs = get_git_data(git_repo, join(root_path, "repo"), revision)
 
     if travis_yml_path:
         yml_content = yml_read(travis_yml_path)
@@ -248,6 +787,11 @@ def main(return_result=False):
         )
         raise InvalidRepoBranchError(msg)
     os_kwargs.update({"remotes": remotes, "git_base": git_base})
+    copy_paths = [(expanduser("~/.ssh"), "$HOME/.ssh")] + rcfiles
+    # The Dockerfile of deployv clones the source by itself
+    if os_kwargs.get("source_bundle_path") and not deployv:
+        os_kwargs["source_bundle"] = "/tmp/source.bundle"
+        copy_paths.append((os_kwargs["source_bundle_path"], os_kwargs["source_bundle"]))
     if docker_user:
         os_kwargs.update({"user": docker_user})
     t2d = Travis2Docker(
@@ -255,11 +799,24 @@ def main(return_result=False):
         work_path=join(root_path, "script", GitRun.url2dirname(git_repo), revision),
         image=default_docker_image,
         os_kwargs=os_kwargs,
-        copy_paths=[(expanduser("~/.ssh"), "$HOME/.ssh")] + rcfiles,
+        copy_paths=copy_paths,
         runs_at_the_end_script=runs_at_the_end_script,
         build_env_args=build_env_args,
         deployv=deployv,
         build_extra_steps=args.build_extra_steps,
+        stage_path=join(root_path, "stage"),
+        yml_key=None if travis_yml_path else os_kwargs.get("content_sha") or None,
+        job_selectors={
+            "python": args.only_python,
+            "env": args.only_env,
+            "job": args.only_job,
+            "vars": [only_var.split("=", 1) for only_var in args.only_vars],
+        },
+        layered=args.layered,
+        cache_mounts=args.cache_mounts,
+        # The repositories without .travis.yml use the Dockerfile of deployv, it has not stages
+        multi_stage=args.multi_stage and not deployv,
+        dedup=args.dedup_jobs,
     )
     t2d.build_extra_params = {
         "extra_params": build_extra_args,
@@ -269,11 +826,38 @@ def main(return_result=False):
         "extra_params": run_extra_args,
         "extra_cmds": run_extra_cmds,
     }
-    fname_scripts = t2d.compute_dockerfile(skip_after_success=exclude_after_success)
+    return t2d
+
+
+def generate_scripts(args, revision, os_kwargs):
+    """Generate the scripts of a revision using the data of the repository
+
+    :return list: The paths of the scripts generated
+    """
+    t2d = get_travis2docker(args, revision, os_kwargs)
+    fname_scripts = t2d.compute_dockerfile(skip_after_success=args.exclude_after_success, workers=args.workers)
+    t2d.gc_stage()
     if fname_scripts:
         fname_list = "- " + "\n- ".join(fname_scripts)
         stdout.write("\nGenerated scripts:\n%s\n" % fname_list)
-        if deployv and not default_docker_image:
+        if t2d.changed_work_paths:
+            stdout.write("\nChanged scripts:\n- %s\n" % "\n- ".join(t2d.changed_work_paths))
+        else:
+            stdout.write("\nNo changes in the generated scripts\n")
+        if t2d.job_aliases:
+            jobs_count = len(set(fname_scripts))
+            contexts_count = jobs_count - len(t2d.job_aliases)
+            stdout.write(
+                "\nIdentical jobs: %d jobs generated as %d build contexts (collapse ratio %.2f)\n- %s\n"
+                % (
+                    jobs_count,
+                    contexts_count,
+                    jobs_count / contexts_count,
+                    "\n- ".join("%s -> %s" % alias for alias in t2d.job_aliases.items()),
+                )
+            )
+        stdout.write("\nBuild all the jobs:\n%s [PARALLEL_BUILDS]\n" % join(t2d.work_path, "build-all.sh"))
+        if t2d.deployv and not args.default_docker_image:
             stdout.write("=" * 80)
             # TODO: Add the URL to open the pipelines
             stdout.write(
@@ -285,5 +869,25 @@ def main(return_result=False):
             stdout.write("=" * 80)
     else:
         stdout.write("\nNo scripts were generated.")
-    if return_result:
-        return fname_scripts
+    return fname_scripts
+
+
+def get_job_plan(args, revision, os_kwargs, job_name):
+    """Render in memory the job of the revision
+
+    :param job_name str: Name of the job e.g. 3_8/env_1_job_1 or its number in the matrix e.g. 1
+    :return JobPlan: The job found
+    """
+    t2d = get_travis2docker(args, revision, os_kwargs)
+    # The build context of the tar is the job with its own Dockerfile
+    t2d.multi_stage = False
+    plans = t2d.compute_plan(skip_after_success=args.exclude_after_success)
+    if job_name.isdigit() and 0 < int(job_name) <= len(plans):
+        return plans[int(job_name) - 1]
+    job_plans = [plan for plan in plans if plan.name == job_name.strip("/")]
+    if not job_plans:
+        raise InvalidRepoBranchError(
+            "The job %s was not found. Jobs: %s" % (job_name, ", ".join(plan.name for plan in plans))
+        )
+    # The last job with the same name is the one used for the scripts generated
+    return job_plans[-1]
@@ -1,8 +1,47 @@
 # pylint: disable=useless-object-inheritance,print-used,except-pass
 
+import contextlib
+import json
 import os
 import re
 import subprocess
+import time
+
+try:
+    import fcntl
+except ImportError:  # e.g. Windows
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+# The fetch of the hot path does not run `git maintenance run --auto` (`git gc --auto` for git < 2.29),
+# the mirrors are repacked by the maintenance command
+NO_AUTO_MAINTENANCE = ["-c", "maintenance.auto=false", "-c", "gc.auto=0"]
+
+
+def lock_file(f_lock, shared=False):
+    """Lock the file between processes, the lock of msvcrt (Windows) is always exclusive"""
+    if fcntl is not None:
+        fcntl.flock(f_lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+    elif msvcrt is not None:
+        f_lock.seek(0)
+        while True:
+            try:
+                # It retries during 10 seconds before raising an error
+                msvcrt.locking(f_lock.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                pass
+
+
+def unlock_file(f_lock):
+    if fcntl is not None:
+        fcntl.flock(f_lock, fcntl.LOCK_UN)
+    elif msvcrt is not None:
+        f_lock.seek(0)
+        msvcrt.locking(f_lock.fileno(), msvcrt.LK_UNLCK, 1)
 
 
 def decode_utf(field):
@@ -12,13 +51,155 @@ def decode_utf(field):
         return ""
 
 
+class CatFile:
+    """Long-lived `git cat-file --batch` (or `--batch-check`) session
+
+    The process is started on the first query and kept open, so reading many
+    objects costs a single fork instead of one `git` process per object.
+    Missing or ambiguous objects are returned as `None`.
+    """
+
+    # Names are written by chunks to avoid filling the stdin pipe
+    # while git is blocked writing big objects into stdout
+    chunk_size = 16384
+
+    def __init__(self, git_cmd, check=False):
+        """:param git_cmd list: git command with the global options e.g. ["git", "--git-dir=PATH"]"""
+        self.git_cmd = git_cmd
+        self.check = check
+        self._proc = None
+
+    def start(self):
+        if self._proc is None or self._proc.poll() is not None:
+            cmd = self.git_cmd + ["cat-file", "--batch-check" if self.check else "--batch"]
+            self._proc = subprocess.Popen(
+                cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+            )
+        return self._proc
+
+    def close(self):
+        if self._proc is None:
+            return
+        try:
+            self._proc.stdin.close()
+        except OSError:
+            pass
+        self._proc.wait()
+        self._proc.stdout.close()
+        self._proc = None
+
+    def _read_object(self, proc):
+        header = proc.stdout.readline()
+        if not header:
+            raise OSError("git cat-file session finished unexpectedly")
+        header = header.decode("utf-8", "replace").rstrip("\n").split(" ")
+        if len(header) != 3 or header[-1] in ("missing", "ambiguous"):
+            return None
+        sha, obj_type, size = header
+        content = None
+        if not self.check:
+            content = proc.stdout.read(int(size))
+            proc.stdout.read(1)  # Trailing newline
+        return sha, obj_type, content
+
+    def query(self, names):
+        """Get a (sha, type, content) tuple for each name or `None` if it is missing"""
+        names = list(names)
+        res = [None] * len(names)
+        valid = [index for index, name in enumerate(names) if name and "\n" not in name]
+        try:
+            proc = self.start()
+            while valid:
+                chunk, size = [], 0
+                while valid and (not chunk or size < self.chunk_size):
+                    chunk.append(valid.pop(0))
+                    size += len(names[chunk[-1]]) + 1
+                proc.stdin.write("".join(names[index] + "\n" for index in chunk).encode("utf-8"))
+                proc.stdin.flush()
+                for index in chunk:
+                    res[index] = self._read_object(proc)
+        except OSError:
+            # e.g. The git dir does not exist yet
+            self.close()
+        return res
+
+
+class RefData:
+    """Compact record of a ref listed by `GitRun.iter_ref_data`
+
+    The tuple of field names is shared by all the records of the same listing
+    """
+
+    __slots__ = ("refname", "fields", "values")
+
+    def __init__(self, refname, fields, values):
+        self.refname = refname
+        self.fields = fields
+        self.values = values
+
+    def __getitem__(self, field):
+        try:
+            return self.values[self.fields.index(field)]
+        except ValueError:
+            raise KeyError(field)
+
+    def __repr__(self):
+        return "RefData(%r, %r)" % (self.refname, self.as_dict())
+
+    def get(self, field, default=None):
+        try:
+            return self[field]
+        except KeyError:
+            return default
+
+    def as_dict(self):
+        return dict(zip(self.fields, self.values))
+
+
 class GitRun:
-    def __init__(self, repo_git, path, path_prefix_repo=False):
+    fetch_record_fname = "t2d_fetch.json"
+
+    def __init__(
+        self, repo_git, path, path_prefix_repo=False, partial_clone=None, offline=False, shared_objects=False
+    ):
+        """:param partial_clone str: Filter spec used to create the mirror as a partial clone
+        e.g. "tree:0" or "blob:none", the missing objects are fetched when they are read
+        :param offline bool: Use only the local mirror, any git transport is disabled
+        :param shared_objects bool: Borrow the objects from a store shared by the forks
+            of the same project (git alternates) instead of a full clone.
+            It is not used for partial clones
+        """
         self.repo_git = repo_git
+        self.partial_clone = partial_clone
+        self.offline = offline
+        self.shared_objects = shared_objects
         if path_prefix_repo:
             path = os.path.join(path, self.url2dirname(repo_git))
         self.path = path
         self.host, self.owner, self.repo = self.get_data_url(repo_git)
+        self._cat_file = CatFile(self.git_cmd)
+        self._cat_file_check = CatFile(self.git_cmd, check=True)
+        self._config = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def git_cmd(self):
+        cmd = ["git", "--git-dir=%s" % self.path]
+        if self.offline:
+            # Even the lazy fetch of the missing objects of a partial clone fails fast
+            cmd += ["-c", "protocol.allow=never"]
+        return cmd
+
+    def close(self):
+        """Finish the `git cat-file` sessions and forget the cached data"""
+        self._cat_file.close()
+        self._cat_file_check.close()
+        self._config = None
 
     @staticmethod
     def get_data_url(repo_git, no_user=True):
@@ -49,15 +230,28 @@ class GitRun:
 
     def get_config_data(self, field=None):
         if field is None:
-            field = "-l"
-        res = self.run(["config", field])
+            res = self.run(["config", "-l"])
+            if res:
+                res = res.strip("\n ")
+            return res
+        if self._config is None:
+            # Read the whole config only once instead of a process per field
+            self._config = {}
+            for item in (self.run(["config", "-z", "-l"]) or "").split("\x00"):
+                key, _, value = item.partition("\n")
+                if key:
+                    self._config[key] = value
+        section, _, name = field.partition(".")
+        subsection, _, name = name.rpartition(".")
+        key = ".".join(part for part in [section.lower(), subsection, name.lower()] if part)
+        res = self._config.get(key)
         if res:
             res = res.strip("\n ")
         return res
 
     def run(self, cmd):
         """Execute git command in bash"""
-        cmd = ["git", "--git-dir=%s" % self.path] + cmd
+        cmd = self.git_cmd + cmd
         print("cmd list", cmd)
         print("cmd", " ".join(cmd))
         res = None
@@ -72,43 +266,319 @@ class GitRun:
                 res = res.decode("utf-8")
         return res
 
-    def get_ref_data(self, refs=None, fields=None):
+    def iter_ref_data(self, refs=None, fields=None, sort="refname"):
+        """Stream the refs from `git for-each-ref` line by line
+
+        :param refs list: Patterns of the refs to list e.g. ["refs/heads", "refs/pull/*"]
+        :param fields list: for-each-ref fields to get besides "refname"
+            e.g. ['objectname', 'committerdate:iso8601', 'authorname', 'authoremail',
+                  'subject', 'committername', 'committeremail']
+        :param sort str: for-each-ref sort key e.g. "-committerdate" for the newest first
+        :return: Iterator of `RefData`
+        """
         if refs is None:
             refs = ["refs/heads"]
+        fields = tuple(field for field in fields or [] if field != "refname")
+        fmt = "%00".join(["%(" + field + ")" for field in ("refname",) + fields])
+        cmd = self.git_cmd + ["for-each-ref", "--format", fmt, "--sort=%s" % sort] + refs
+        print("cmd", " ".join(cmd))
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            for line in proc.stdout:
+                line = line.rstrip(b"\n")
+                if not line:
+                    continue
+                values = [decode_utf(value) for value in line.split(b"\x00")]
+                yield RefData(values[0], fields, tuple(values[1:]))
+        finally:
+            proc.stdout.close()
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+
+    def get_ref_data(self, refs=None, fields=None):
         if fields is None:
             fields = []
         if "refname" not in fields:
             fields.append("refname")
-        # fields = ['refname', 'objectname', 'committerdate:iso8601',
-        #           'authorname', 'authoremail','subject','committername',
-        #           'committeremail']
-        fmt = "%00".join(["%(" + field + ")" for field in fields])
-        git_refs = self.run(["for-each-ref", "--format", fmt, "--sort=refname"] + refs)
-        git_refs = git_refs.strip()
-        refs = [[decode_utf(field) for field in line.split("\x00")] for line in git_refs.split("\n")]
-        res = {}
-        for data_field in refs:
-            subres = dict(zip(fields, data_field))
-            res[subres.pop("refname")] = subres
-        return res
+        return {ref_data.refname: ref_data.as_dict() for ref_data in self.iter_ref_data(refs, fields)}
+
+    @staticmethod
+    def revision_refspecs(revision):
+        """Alternative refspecs to fetch only the revision from origin
+
+        The first one that succeeds is enough e.g. github or gitlab pull requests
+        """
+        if revision.startswith("pull/"):
+            number = revision[len("pull/") :]
+            return [
+                # github support
+                ["+refs/pull/%s/head:refs/pull/%s" % (number, number)],
+                # gitlab support
+                ["+refs/merge-requests/%s/head:refs/pull/%s" % (number, number)],
+            ]
+        return [["+refs/heads/%s:refs/heads/%s" % (revision, revision)]]
+
+    def fetch(self, refspecs, prune=False):
+        """Fetch the refspecs from origin and return True if it was successful"""
+        cmd = self.git_cmd + NO_AUTO_MAINTENANCE + ["fetch"] + (["-p"] if prune else []) + ["origin"] + refspecs
+        print("cmd", " ".join(cmd))
+        return subprocess.call(cmd) == 0
+
+    def get_refs_sha(self):
+        res = self.run(["for-each-ref", "--format=%(objectname) %(refname)"]) or ""
+        return {refname: sha for sha, _, refname in (line.partition(" ") for line in res.splitlines())}
+
+    def get_objects_size(self):
+        size = 0
+        for root, _, fnames in os.walk(os.path.join(self.path, "objects")):
+            for fname in fnames:
+                try:
+                    size += os.path.getsize(os.path.join(root, fname))
+                except OSError:
+                    pass  # e.g. Removed by a repack
+        return size
+
+    def is_cloned(self):
+        return os.path.isdir(os.path.join(self.path, "refs"))
+
+    def get_fetch_record(self):
+        """Last fetch time by revision, "*" is used for the full refresh"""
+        try:
+            with open(os.path.join(self.path, self.fetch_record_fname)) as f_record:
+                return json.load(f_record)
+        except (OSError, ValueError):
+            return {}
+
+    def set_fetch_record(self, revision, fetch_time):
+        record = self.get_fetch_record()
+        record[revision] = fetch_time
+        record_path = os.path.join(self.path, self.fetch_record_fname)
+        with open(record_path + ".tmp", "w") as f_record:
+            json.dump(record, f_record, indent=4, sort_keys=True)
+        os.replace(record_path + ".tmp", record_path)
+
+    def get_fetch_time(self, revision=None):
+        """Last time the revision was fetched or `None` if it was never fetched"""
+        record = self.get_fetch_record()
+        fetch_times = [record.get("*")] + ([record.get(revision)] if revision is not None else [])
+        fetch_times = [fetch_time for fetch_time in fetch_times if fetch_time is not None]
+        return max(fetch_times) if fetch_times else None
+
+    def get_fetch_age(self, revision=None):
+        """Seconds since the revision was fetched or `None` if it was never fetched"""
+        fetch_time = self.get_fetch_time(revision)
+        return None if fetch_time is None else time.time() - fetch_time
+
+    @contextlib.contextmanager
+    def lock(self, shared=False):
+        """Lock the mirror between processes
+
+        Use `shared=True` to read it and an exclusive lock to update it,
+        without fcntl (e.g. Windows) the lock of msvcrt is exclusive for the readers too
+        """
+        lock_dir = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(lock_dir):
+            os.makedirs(lock_dir, exist_ok=True)
+        with open(os.path.abspath(self.path) + ".lock", "a") as f_lock:
+            lock_file(f_lock, shared)
+            try:
+                yield
+            finally:
+                unlock_file(f_lock)
+
+    def update(self, revision=None, max_age=None):
+        """Get a repository git or update it
+
+        The concurrent callers are coalesced: If the revision was fetched by other
+        process while waiting for the lock the fetch is skipped
+        :param revision str: Fetch only this branch or `pull/#` instead of all the refs
+        :param max_age int: Skip the fetch if it was done less than `max_age` seconds ago
+        :return dict: Stats of the update strategy used
+            with the number of refs changed, the bytes fetched and if the fetch was successful
+        """
+        request_time = time.time()
+        with self.lock():
+            return self._update(revision, max_age, request_time)
 
-    def update(self):
-        """Get a repository git or update it"""
+    def _update(self, revision, max_age, request_time):
         if not os.path.isdir(os.path.join(self.path)):
             os.makedirs(self.path)
-        if not os.path.isdir(os.path.join(self.path, "refs")):
-            subprocess.check_output(["git", "clone", "--bare", self.repo_git, self.path])
-        self.run(["gc", "--auto", "--prune=all"])
-        self.run(["fetch", "-p", "origin", "+refs/heads/*:refs/heads/*"])
-        # github support
-        self.run(["fetch", "origin", "+refs/pull/*/head:refs/pull/*"])
-        # gitlab support
-        self.run(["fetch", "origin", "+refs/merge-requests/*/head:refs/pull/*"])
+        fetch_time = self.get_fetch_time(revision)
+        if self.is_cloned() and fetch_time is not None:
+            if fetch_time >= request_time:
+                print("update coalesced: %s fetched by other process" % (revision or "*"))
+                return {"strategy": "coalesced", "refs": 0, "bytes": 0, "fetched": True}
+            if max_age is not None and time.time() - fetch_time <= max_age:
+                print("update skipped: %s fetched %d seconds ago" % (revision or "*", time.time() - fetch_time))
+                return {"strategy": "fresh", "refs": 0, "bytes": 0, "fetched": True}
+        fetch_time = time.time()
+        refs_before, size_before = {}, 0
+        if not self.is_cloned():
+            cmd = ["git", "clone", "--bare"]
+            if self.partial_clone:
+                cmd.append("--filter=%s" % self.partial_clone)
+            elif self.shared_objects:
+                shared_store = self.get_shared_store()
+                shared_store.import_objects(self.repo_git, self.url2dirname(self.repo_git))
+                cmd.extend(["--reference-if-able", shared_store.path])
+            subprocess.check_output(cmd + [self.repo_git, self.path])
+        else:
+            refs_before, size_before = self.get_refs_sha(), self.get_objects_size()
+        strategy, fetched = "targeted", True
+        if revision is None or not any(self.fetch(refspecs) for refspecs in self.revision_refspecs(revision)):
+            strategy = "full"
+            fetched = self.fetch(["+refs/heads/*:refs/heads/*"], prune=True)
+            # github support
+            self.fetch(["+refs/pull/*/head:refs/pull/*"])
+            # gitlab support
+            self.fetch(["+refs/merge-requests/*/head:refs/pull/*"])
+        if fetched:
+            self.set_fetch_record(revision if strategy == "targeted" else "*", fetch_time)
+        # The running sessions could not see the new refs
+        self.close()
+        refs_after = self.get_refs_sha()
+        refs_changed = [
+            ref for ref in set(refs_before) | set(refs_after) if refs_before.get(ref) != refs_after.get(ref)
+        ]
+        stats = {
+            "strategy": strategy,
+            "refs": len(refs_changed),
+            "bytes": max(self.get_objects_size() - size_before, 0),
+            "fetched": fetched,
+        }
+        print("update %(strategy)s: %(refs)d refs changed, %(bytes)d bytes fetched" % stats)
+        return stats
+
+    def get_alternates(self):
+        try:
+            with open(os.path.join(self.path, "objects", "info", "alternates")) as f_alternates:
+                return [line.strip() for line in f_alternates if line.strip()]
+        except OSError:
+            return []
+
+    def get_shared_store(self):
+        """GitRun of the object store shared by the forks of the same project
+
+        The forks are grouped by host and repository name
+        e.g. github.com/odoo/odoo and github.com/Vauxoo/odoo
+        """
+        repo_name = re.sub(r"\.git$", "", os.path.basename(self.repo_git.replace(":", "/").rstrip("/")))
+        family = self.url2dirname("%s_%s" % (self.host or "local", repo_name)).lower()
+        return GitRun(self.repo_git, os.path.join(os.path.dirname(os.path.abspath(self.path)), ".shared", family))
+
+    def import_objects(self, source, namespace, refs=None):
+        """Fetch the objects of the source (url or path of a mirror) into this shared store
+
+        The refs of each fork are kept in its own namespace to avoid pruning their objects,
+        the tags too because the mirror drops the objects borrowed from this store
+        """
+        if refs is None:
+            refs = ["heads", "tags"]
+        with self.lock():
+            if not self.is_cloned():
+                subprocess.check_output(["git", "init", "-q", "--bare", self.path])
+            refspecs = ["+refs/%s/*:refs/t2d/%s/%s/*" % (ref, namespace, ref) for ref in refs]
+            return self.run(NO_AUTO_MAINTENANCE + ["fetch", "-q", "--no-tags", source] + refspecs)
+
+    def maintenance(self, auto=True):
+        """Repack and prune the mirror out of the hot path of `update`
+
+        The objects of a mirror with a shared store are moved to the shared store
+        """
+        if not self.is_cloned():
+            return None
+        with self.lock():
+            self.close()
+            for alternate in self.get_alternates():
+                shared_store = GitRun(self.repo_git, os.path.dirname(alternate))
+                if os.path.basename(os.path.dirname(shared_store.path)) != ".shared":
+                    continue
+                shared_store.import_objects(self.path, self.url2dirname(self.repo_git), ["heads", "pull", "tags"])
+                # Drop the local objects that are now borrowed from the shared store
+                self.run(["repack", "-a", "-d", "-l", "-q"])
+                with shared_store.lock():
+                    # Never prune the shared store aggressively, other mirrors borrow its objects
+                    shared_store.run(["gc", "--auto"])
+            return self.run(["gc", "--prune=all"] + (["--auto"] if auto else []))
+
+    def is_partial_clone(self):
+        return self.get_config_data("remote.origin.promisor") == "true"
+
+    def fetch_missing_objects(self, git_files, sha):
+        """Fetch the objects needed to read the files from a partial clone
+
+        All the missing blobs (and trees for "tree:0") are requested in the same fetch
+        instead of the one-by-one lazy fetch done by git
+        """
+        # The trees are fetched level by level
+        for _ in range(max(git_file.count("/") for git_file in git_files) + 2):
+            res = self.run(["rev-list", "--objects", "--missing=print", "--no-walk", sha, "--"] + git_files)
+            if res is None:
+                # The root tree is missing, it can not be walked
+                commit = self._cat_file.query([sha])[0]
+                if commit is None or commit[1] != "commit":
+                    return
+                missing = [decode_utf(commit[2]).split("\n", 1)[0].replace("tree ", "")]
+            else:
+                missing = [line[1:].split(" ")[0] for line in res.splitlines() if line.startswith("?")]
+            if not missing:
+                return
+            cmd = NO_AUTO_MAINTENANCE + ["-c", "fetch.negotiationAlgorithm=noop"]
+            cmd += ["fetch", "origin", "--no-tags", "--no-write-fetch-head"]
+            if self.get_config_data("remote.origin.partialclonefilter"):
+                cmd.append("--filter=%s" % self.get_config_data("remote.origin.partialclonefilter"))
+            if self.run(cmd + missing) is None:
+                return
+
+    def show_files(self, git_files, sha):
+        """Read several files of the same revision using a single request
+
+        :return dict: The content of each file or `None` if it does not exist
+        """
+        if self.is_partial_clone() and any(git_files) and not self.offline:
+            self.fetch_missing_objects([git_file for git_file in git_files if git_file], sha)
+        objects = self._cat_file.query(["%s:%s" % (sha, git_file) for git_file in git_files])
+        res = {}
+        for git_file, git_object in zip(git_files, objects):
+            if git_object is None or git_object[1] != "blob":
+                res[git_file] = None
+                continue
+            res[git_file] = decode_utf(git_object[2])
+        return res
+
+    @staticmethod
+    def revision2ref(revision):
+        """Ref of the mirror for the revision e.g. pull/1 -> refs/pull/1"""
+        if revision.startswith("pull/"):
+            return "refs/" + revision
+        return "refs/heads/" + revision
+
+    def create_bundle(self, revision, bundle_path):
+        """Export the revision from the mirror as a git bundle
+
+        The bundle is reused if it already has the current sha of the revision
+        :return str: The ref of the bundle or `None` if it can not be created e.g. a partial clone
+        """
+        ref = self.revision2ref(revision)
+        sha = self.get_sha(ref)
+        if not sha or self.is_partial_clone():
+            return None
+        if os.path.isfile(bundle_path):
+            heads = self.run(["bundle", "list-heads", bundle_path, ref]) or ""
+            if heads.split(" ")[0] == sha:
+                return ref
+        if not os.path.isdir(os.path.dirname(bundle_path)):
+            os.makedirs(os.path.dirname(bundle_path))
+        if self.run(["bundle", "create", "-q", bundle_path + ".tmp", ref]) is None:
+            return None
+        os.replace(bundle_path + ".tmp", bundle_path)
+        return ref
 
     def show_file(self, git_file, sha):
-        result = self.run(["show", "%s:%s" % (sha, git_file)])
-        return result
+        return self.show_files([git_file], sha)[git_file]
 
     def get_sha(self, revision):
-        result = self.run(["rev-parse", revision])
-        return result if isinstance(result, list) else (result or "").strip(" \n")
+        """Get the sha of the revision or an empty string if it does not exist"""
+        git_object = self._cat_file_check.query([revision])[0]
+        return git_object[0] if git_object else ""
@@ -1,4 +1,7 @@
 #!/bin/bash
+{% if buildkit -%}
+export DOCKER_BUILDKIT=1
+{% endif -%}
 export IMAGE={{ image }}
-docker build --pull {{ extra_params }} $1 -t $IMAGE {{ dirname_dockerfile }}
+docker build --pull {{ extra_params }} $1 -t $IMAGE {% if target %}--target {{ target }} {% endif %}{{ dirname_dockerfile }}
 {{ extra_cmds }}
@@ -1,6 +1,6 @@
 #!/bin/bash
 export IMAGE={{ image }}
-CONTAINER=$(docker run {{ extra_params }} $1 -ditP $IMAGE $2)
+CONTAINER=$(docker run {{ extra_params }}{% for name, path in volumes %} -v {{ name }}:{{ path }}{% endfor %} $1 -ditP $IMAGE $2)
 
 # Some files under /home/odoo end up owned by root or other users (declared VOLUMEs and
 # files shared into the container); fix their ownership in the background so we can attach ASAP
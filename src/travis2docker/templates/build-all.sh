@@ -0,0 +1,51 @@
+#!/bin/bash
+# Build the images of all the jobs: ./build-all.sh [PARALLEL_BUILDS]
+# The bases are built first, then the stages in order building the jobs of the same stage at the same time.
+# The status and seconds of each build are saved in {{ summary }} and its output in {{ logs }}/
+cd "$(dirname "$0")" || exit 1
+PARALLEL=${1:-$(getconf _NPROCESSORS_ONLN)}
+export SUMMARY={{ summary }}
+mkdir -p {{ logs }}
+printf 'job\tstage\tstatus\tseconds\n' > "$SUMMARY"
+
+build() {
+    # build STAGE NAME COMMAND...
+    local stage=$1 name=$2 start status
+    shift 2
+    start=$(date +%s)
+    "$@" > "{{ logs }}/${name//\//_}.log" 2>&1
+    status=$?
+    printf '%s\t%s\t%s\t%s\n' "$name" "$stage" "$status" "$(($(date +%s) - start))" >> "$SUMMARY"
+    return $status
+}
+export -f build
+{%- if bases %}
+
+build_base() {
+    # build_base VERSION_PATH/BASE
+    build base "$1" docker build --pull {{ extra_params }} --target "${1##*/}" "${1%/*}"
+}
+export -f build_base
+{%- endif %}
+{%- if buildkit %}
+
+# BuildKit builds only the stages used by the target
+export DOCKER_BUILDKIT=1
+{%- endif %}
+
+STATUS=0
+{%- if bases %}
+printf '%s\0' \
+{%- for version_path, base in bases %}
+    {{ version_path }}/{{ base }} \
+{%- endfor %}
+    | xargs -0 -n 1 -P "$PARALLEL" bash -c 'build_base "$1"' base || STATUS=1
+{%- endif %}
+{%- for stage, work_paths in stages %}
+printf '%s\0' \
+{%- for work_path in work_paths %}
+    {{ work_path }} \
+{%- endfor %}
+    | xargs -0 -n 1 -P "$PARALLEL" bash -c 'build "$0" "$1" "$1/10-build.sh"' {{ stage }} || STATUS=1
+{%- endfor %}
+exit $STATUS
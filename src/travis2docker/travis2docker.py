@@ -1,33 +1,301 @@
 # pylint: disable=useless-object-inheritance,consider-using-with,too-complex,print-used
 import collections
+import copy
 import errno
+import hashlib
+import io
+import itertools
 import json
+import marshal
 import os
+import posixpath
 import re
+import shlex
 import shutil
 import stat
-from tempfile import gettempdir
+import tarfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from tempfile import gettempdir, mkdtemp
 
 import jinja2
+import yaml
 
 try:
-    from yaml import full_load as yaml_load
+    from yaml import CFullLoader as YamlLoader  # Use libyaml if it is available
 except ImportError:
-    from yaml import load as yaml_load
+    try:
+        from yaml import FullLoader as YamlLoader
+    except ImportError:
+        from yaml import Loader as YamlLoader
 
 RE_ENV_STR = r"(?P<var>[\w]*)[ ]*[\=][ ]*[\"\']{0,1}" + r"(?P<value>[\w\.\-\_/\$\{\}\:,\(\)\#\* ]*)[\"\']{0,1}"
 RE_EXPORT_STR = r"^(?P<export>export|EXPORT)( )+" + RE_ENV_STR
 
+JINJA_ENVS = {}
+JINJA_ENVS_LOCK = threading.Lock()
+
+
+def get_jinja_env(templates_path):
+    """Jinja environment shared by all the instances using the same templates path
+
+    The compiled templates are saved in the bytecode cache of jinja (a directory of the temporary path),
+    jinja compares the checksum of the source so a template changed is compiled again
+    """
+    templates_path = os.path.realpath(templates_path)
+    with JINJA_ENVS_LOCK:
+        jinja_env = JINJA_ENVS.get(templates_path)
+        if jinja_env is None:
+            jinja_env = jinja2.Environment(
+                loader=jinja2.FileSystemLoader(templates_path),
+                bytecode_cache=jinja2.FileSystemBytecodeCache(),
+            )
+            JINJA_ENVS[templates_path] = jinja_env
+    return jinja_env
+
+
+YML_CACHE = collections.OrderedDict()
+YML_CACHE_SIZE = 256
+YML_CACHE_LOCK = threading.Lock()
+
+
+def yaml_load(yml_buffer, yml_key=None):
+    """Parse the yml content, the result is reused for the same `yml_key` e.g. the sha of the git blob
+
+    A copy is returned because the yml parsed is modified to compute the jobs
+    """
+    if yml_key is None:
+        return yaml.load(yml_buffer, Loader=YamlLoader)
+    with YML_CACHE_LOCK:
+        yml = YML_CACHE.get(yml_key)
+        if yml is not None:
+            YML_CACHE.move_to_end(yml_key)
+    if yml is None:
+        yml = yaml.load(yml_buffer, Loader=YamlLoader)
+        with YML_CACHE_LOCK:
+            YML_CACHE[yml_key] = yml
+            while len(YML_CACHE) > YML_CACHE_SIZE:
+                YML_CACHE.popitem(last=False)
+    return copy.deepcopy(yml)
+
+
+APT_SOURCES = {}
+APT_SOURCES_LOCK = threading.Lock()
+APT_WHITELIST_PATH = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), "travis-ci-apt-source-whitelist", "ubuntu.json"
+)
+
+
+def get_apt_sources(whitelist_path=APT_WHITELIST_PATH, cache_path=None):
+    """Sources of the apt whitelist of travis indexed by alias, loaded only once in the process
+
+    The index is saved in `cache_path` (by default in ~/.cache/travis2docker) to avoid to parse the json
+    file again, the cache is used only for the same path, size and mtime of the json file.
+
+    :return dict: {alias: [(key_url, sourceline)]}
+    """
+    whitelist_path = os.path.realpath(whitelist_path)
+    with APT_SOURCES_LOCK:
+        if whitelist_path in APT_SOURCES:
+            return APT_SOURCES[whitelist_path]
+        if cache_path is None:
+            cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(os.path.join("~", ".cache"))
+            cache_path = os.path.join(cache_dir, "travis2docker", "apt_sources.marshal")
+        whitelist_stat = os.stat(whitelist_path)
+        signature = (whitelist_path, whitelist_stat.st_size, whitelist_stat.st_mtime_ns)
+        apt_sources = None
+        try:
+            with open(cache_path, "rb") as f_cache:
+                cache_signature, cache_apt_sources = marshal.load(f_cache)
+            if cache_signature == signature:
+                apt_sources = cache_apt_sources
+        except (IOError, OSError, EOFError, ValueError, TypeError):  # pylint: disable=except-pass
+            pass
+        if apt_sources is None:
+            apt_sources = {}
+            with open(whitelist_path) as f_whitelist:
+                for ubuntu_source in json.load(f_whitelist):
+                    apt_sources.setdefault(ubuntu_source["alias"], []).append(
+                        (ubuntu_source["key_url"], ubuntu_source["sourceline"])
+                    )
+            try:
+                Travis2Docker.mkdir_p(os.path.dirname(cache_path))
+                with open(cache_path + ".tmp", "wb") as f_cache:
+                    marshal.dump((signature, apt_sources), f_cache)
+                os.replace(cache_path + ".tmp", cache_path)
+            except (IOError, OSError):  # pylint: disable=except-pass
+                pass  # The cache is optional
+        APT_SOURCES[whitelist_path] = apt_sources
+    return apt_sources
+
+
+def get_dockerfile_steps(content):
+    """Instructions of a Dockerfile, the lines continued with a backslash are joined
+
+    :return list: The instructions without the empty lines and comments
+    """
+    steps = []
+    step = ""
+    for line in content.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.endswith("\\"):
+            step += line[:-1].strip() + " "
+            continue
+        steps.append(step + line)
+        step = ""
+    if step:
+        steps.append(step.strip())
+    return steps
+
+
+def get_context_hash(context_path, srcs):
+    """Hash of the names, modes and content of the files of the build context copied"""
+    context_hash = hashlib.sha1()
+    for src in srcs:
+        src_path = os.path.normpath(os.path.join(context_path, src))
+        paths = [src_path]
+        if os.path.isdir(src_path):
+            for dirpath, dirnames, fnames in os.walk(src_path):
+                dirnames.sort()
+                paths.extend(os.path.join(dirpath, fname) for fname in sorted(fnames))
+        for path in paths:
+            relpath = os.path.relpath(path, context_path)
+            if not os.path.isfile(path):
+                context_hash.update(("%s missing\n" % relpath).encode("utf-8"))
+                continue
+            context_hash.update(("%s %o\n" % (relpath, stat.S_IMODE(os.stat(path).st_mode))).encode("utf-8"))
+            with open(path, "rb") as f_src:
+                context_hash.update(f_src.read())
+    return context_hash.hexdigest()
+
+
+def diff_layers(context_a, context_b, dockerfile="Dockerfile"):
+    """First step of the Dockerfiles of two build contexts (e.g. work paths of jobs) that is different
+
+    The steps after it can not use the cache of docker from the other build.
+    The COPY and ADD steps compare the content of the files copied too.
+
+    :return dict: {"step": number, "a": step, "b": step, "reason": "instruction" or "content"}
+        or `None` if all the steps are the same
+    """
+    contexts_steps = []
+    for context in (context_a, context_b):
+        with open(os.path.join(context, dockerfile)) as f_dockerfile:
+            contexts_steps.append(get_dockerfile_steps(f_dockerfile.read()))
+    for number, (step_a, step_b) in enumerate(itertools.zip_longest(*contexts_steps), 1):
+        if step_a != step_b:
+            return {"step": number, "a": step_a, "b": step_b, "reason": "instruction"}
+        instruction = step_a.split()
+        if instruction[0].upper() not in ("COPY", "ADD"):
+            continue
+        srcs = [arg for arg in instruction[1:-1] if not arg.startswith("--")]
+        if get_context_hash(context_a, srcs) != get_context_hash(context_b, srcs):
+            return {"step": number, "a": step_a, "b": step_b, "reason": "content"}
+    return None
+
+
+RENDER_T2D = None
+
+
+def init_render_process(t2d):
+    """Initializer of the processes rendering the jobs, the Travis2Docker object is sent once by process"""
+    global RENDER_T2D  # pylint: disable=global-statement
+    RENDER_T2D = t2d
+
+
+def render_job(job, skip_after_success=False):
+    """Render a job in memory in a process of the pool, the files are written by the main process"""
+    return RENDER_T2D.compute_job(job, skip_after_success, plan=True)
+
+
+class JobPlan:
+    """Build context of a job of the matrix rendered in memory"""
+
+    def __init__(self, name, python_version, env):
+        #: Name of the job e.g. 3_8/env_1_job_1, the same than the sub-directory of the work path
+        self.name = name
+        self.python_version = python_version
+        self.env = env
+        self.image = None
+        #: {relative path: (content, executable)} of the files rendered
+        self.files = collections.OrderedDict()
+        #: [(source path, relative path)] of the paths copied
+        self.copies = []
+        #: Base and job stages of the multi-stage Dockerfile of the python version
+        self.stages = None
+
+    def __repr__(self):
+        return "JobPlan(%r)" % self.name
+
+    def get_content_hash(self):
+        """Hash of the build context, the scripts to build and run are not used because the image is of the job"""
+        content_hash = hashlib.sha1()
+        for relpath, (content, executable) in sorted(self.files.items()):
+            if relpath in ("10-build.sh", "20-run.sh"):
+                continue
+            content_hash.update(("%s\0%s\0%s\0" % (relpath, executable, content)).encode("utf-8"))
+        for src, relpath in self.copies:
+            content_hash.update(("%s\0%s\0" % (src, relpath)).encode("utf-8"))
+        return content_hash.hexdigest()
+
+    def write_tar(self, fileobj):
+        """Write the build context as a tar stream e.g. for `docker build -`"""
+        with tarfile.open(fileobj=fileobj, mode="w|", dereference=True) as tar:
+            for src, relpath in self.copies:
+                # The files rendered replace the copied ones e.g. .ssh/authorized_keys
+                tar.add(src, arcname=relpath, filter=lambda info: None if info.name in self.files else info)
+            for relpath, (content, executable) in self.files.items():
+                data = content.encode("utf-8")
+                info = tarfile.TarInfo(relpath)
+                info.size = len(data)
+                info.mode = 0o755 if executable else 0o644
+                info.mtime = int(time.time())
+                tar.addfile(info, io.BytesIO(data))
+
 
 class Travis2Docker:
+    # Directories of the cache of travis with the name of the cache e.g. "cache: pip"
+    cache_dirs = {
+        "pip": ["$HOME/.cache/pip"],
+        "npm": ["$HOME/.npm"],
+        "ccache": ["$HOME/.ccache"],
+        "apt": ["/var/cache/apt", "/var/lib/apt/lists"],
+    }
+    # Cache mounts of the directories of the build directory, they are copied from and to the directory
+    cache_tree_path = "/tmp/t2d_cache"
     re_export = re.compile(RE_EXPORT_STR, re.M)
+    manifest_fname = ".t2d_manifest.json"
+
+    # The state of the job in progress
+    @property
+    def curr_work_path(self):
+        return getattr(self._local, "curr_work_path", None)
+
+    @curr_work_path.setter
+    def curr_work_path(self, value):
+        self._local.curr_work_path = value
+
+    @property
+    def curr_exports(self):
+        if not hasattr(self._local, "curr_exports"):
+            self._local.curr_exports = []
+        return self._local.curr_exports
+
+    @curr_exports.setter
+    def curr_exports(self, value):
+        self._local.curr_exports = value
 
     @property
     def dockerfile_template(self):
         dockerfile = "Dockerfile"
         if self.deployv:
             dockerfile += "_deployv"
-        return self.jinja_env.get_template(dockerfile)
+        elif self.layered:
+            dockerfile += "_layered"
+        return self.get_template(dockerfile)
 
     @property
     def new_image(self):
@@ -40,15 +308,22 @@ class Travis2Docker:
 
     @property
     def entrypoint_template(self):
-        return self.jinja_env.get_template("entrypoint.sh")
+        return self.get_template("entrypoint.sh")
 
     @property
     def build_template(self):
-        return self.jinja_env.get_template("10-build.sh")
+        return self.get_template("10-build.sh")
 
     @property
     def run_template(self):
-        return self.jinja_env.get_template("20-run.sh")
+        return self.get_template("20-run.sh")
+
+    def get_template(self, name):
+        """Template loaded only once for all the jobs"""
+        template = self._templates.get(name)
+        if template is None:
+            template = self._templates[name] = self.jinja_env.get_template(name)
+        return template
 
     @staticmethod
     def chmod_execution(file_path):
@@ -77,10 +352,22 @@ class Travis2Docker:
         build_env_args=None,
         deployv=None,
         build_extra_steps=None,
+        stage_path=None,
+        yml_key=None,
+        job_selectors=None,
+        layered=False,
+        cache_mounts=False,
+        multi_stage=False,
+        dedup=False,
     ):
         self._python_versions = []
-        self.curr_work_path = None
-        self.curr_exports = []
+        self._local = threading.local()
+        self._scripts_cache = {}
+        self.changed_work_paths = []
+        self._job_stages = {}
+        self.travis_stages = []
+        self.job_aliases = collections.OrderedDict()
+        self.reset()
         self.build_extra_params = {}
         self.run_extra_params = {}
         self.build_env_args = build_env_args
@@ -127,31 +414,50 @@ class Travis2Docker:
         if templates_path is None:
             templates_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "templates")
         self.copy_paths = copy_paths
+        self.stage_path = stage_path
+        self.job_selectors = job_selectors or {}
+        # The stages of the jobs use the steps of the layered Dockerfile
+        self.layered = layered or multi_stage
+        self.multi_stage = multi_stage
+        self.dedup = dedup
+        self.cache_mounts = cache_mounts
+        self._pub_key = None
         self.os_kwargs = os_kwargs
-        self.jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(templates_path))
+        self.templates_path = templates_path
+        self.jinja_env = get_jinja_env(templates_path)
+        self._templates = {}
         self.image = image
         self._sections = collections.OrderedDict()
         self._sections["env"] = "env"
         self._sections["addons"] = "addons"
+        self._sections["cache"] = "cache"
         self._sections["before_install"] = "run"
         self._sections["install"] = "run"
         self._sections["script"] = "entrypoint"
         self._sections["after_success"] = "entrypoint"
-        self.yml = yaml_load(yml_buffer)
+        self.yml = yaml_load(yml_buffer, yml_key)
         if work_path is None:
             base_name = os.path.splitext(os.path.basename(__file__))[0]
             self.work_path = os.path.join(gettempdir(), base_name)
         else:
             self.work_path = os.path.expandvars(os.path.expanduser(work_path))
         self.dockerfile = dockerfile
+        self.unknown_apt_sources = set()
 
-        travis_ci_apt_src = os.path.join(
-            os.path.dirname(os.path.realpath(__file__)),
-            "travis-ci-apt-source-whitelist",
-        )
-        self.ubuntu_json = json.load(
-            open(os.path.join(travis_ci_apt_src, "ubuntu.json"))
-        )  # pylint: disable=consider-using-with
+    def __getstate__(self):
+        """State sent to the processes rendering the jobs, the jinja environment and the caches are not sent"""
+        state = self.__dict__.copy()
+        for key in ("_local", "jinja_env", "_templates", "_scripts_cache"):
+            state.pop(key)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self.jinja_env = get_jinja_env(self.templates_path)
+        self._templates = {}
+        self._scripts_cache = {}
+        self.reset()
 
     def _compute(self, section, yml=None):
         if yml is None:
@@ -197,68 +503,197 @@ class Travis2Docker:
         if "apt" not in data:
             return
         sources = []
-        for alias in data["apt"].get("sources") or []:
-            for ubuntu_source in self.ubuntu_json:
-                if alias == ubuntu_source["alias"]:
-                    if ubuntu_source["key_url"]:
-                        sources.append('curl -sSL "' + ubuntu_source["key_url"] + '" | apt-key add -')
-                    if ubuntu_source["sourceline"].startswith("ppa:"):
-                        sources.append('apt-add-repository -y "' + ubuntu_source["sourceline"] + '"')
-                    else:
-                        sources.append(
-                            'echo "' + ubuntu_source["sourceline"] + '" | tee -a /etc/apt/sources.list > /dev/null'
-                        )
+        aliases = data["apt"].get("sources") or []
+        apt_sources = get_apt_sources() if aliases else {}
+        for alias in aliases:
+            try:
+                alias_sources = apt_sources.get(alias)
+            except TypeError:  # e.g. sourceline and key_url instead of alias
+                alias_sources = None
+            if not alias_sources:
+                if str(alias) not in self.unknown_apt_sources:
+                    self.unknown_apt_sources.add(str(alias))
+                    print("The apt source %s is not in the whitelist of travis, it is not added" % alias)
+                continue
+            for key_url, sourceline in alias_sources:
+                if key_url:
+                    sources.append('curl -sSL "' + key_url + '" | apt-key add -')
+                if sourceline.startswith("ppa:"):
+                    sources.append('apt-add-repository -y "' + sourceline + '"')
+                else:
+                    sources.append('echo "' + sourceline + '" | tee -a /etc/apt/sources.list > /dev/null')
         new_data = data["apt"].copy()
         new_data["sources"] = sources
         return new_data
 
+    def _compute_cache(self, data, _, __):
+        if not self.cache_mounts:
+            return None
+        if isinstance(data, dict):
+            caches = data.items()
+        else:
+            # e.g. "cache: pip" or "cache: [pip, npm]"
+            caches = [(cache, True) for cache in data]
+        cache_dirs = []
+        for cache, value in caches:
+            if cache == "directories":
+                cache_dirs.extend(value or [])
+            elif value:
+                cache_dirs.extend(self.cache_dirs.get(cache, []))
+        return {"cache_dirs": cache_dirs}
+
+    def get_cache_volumes(self, cache_dirs):
+        """Name and absolute path of the volume of each directory of the cache
+
+        The name is the same for all the builds and containers of the repository.
+        The directories of the build directory (e.g. node_modules) are part of the tree of the repository,
+        they are not mounted in place but copied from and to the cache in the same step
+
+        :return list: [(name, path, the path is in the build directory)]
+        """
+        user = self.os_kwargs["user"]
+        home = "/root" if user == "root" else "/home/%s" % user
+        build_dir = posixpath.join(
+            home, "build", self.os_kwargs.get("repo_owner", ""), self.os_kwargs.get("repo_project", "")
+        )
+        volumes = collections.OrderedDict()
+        for cache_dir in cache_dirs:
+            path = "%s" % cache_dir
+            for home_var in ("${HOME}", "$HOME", "~"):
+                if path.startswith(home_var):
+                    path = home + path[len(home_var) :]
+            # The relative paths of travis are in the build directory
+            path = posixpath.normpath(posixpath.join(build_dir, path))
+            name = "t2d_%s_%s_%s" % (
+                self.os_kwargs.get("repo_owner", ""),
+                self.os_kwargs.get("repo_project", ""),
+                path.strip("/"),
+            )
+            volumes[path] = re.sub(r"[^a-zA-Z0-9_.-]", "_", name).lower()
+        return [(name, path, path.startswith(build_dir + "/")) for path, name in volumes.items()]
+
     def _make_script(self, data, section, add_entrypoint=False, add_run=False, prefix=""):
         file_path = os.path.join(self.curr_work_path, prefix, section)
-        self.mkdir_p(os.path.dirname(file_path))
-        with open(file_path, "w") as f_section:
-            f_section.write("#!/bin/bash\n")
-            for var, value in self.curr_exports:
-                f_section.write("\nexport %s=%s" % (var, value))
-            for line in data:
-                self.curr_exports.extend([(var, value) for _, _, var, value in self.re_export.findall(line)])
-                f_section.write("\n" + line)
-            if section == "script":
-                for run_at_the_end_script in self.runs_at_the_end_script:
-                    f_section.write("\n%s" % run_at_the_end_script)
-        src = "./" + os.path.relpath(file_path, self.curr_work_path)
+        # The same section is used by many jobs of the matrix with the same exports
+        try:
+            script_key = (section, tuple(data), tuple(self.curr_exports), add_entrypoint, add_run, prefix)
+            script_data = self._scripts_cache.get(script_key)
+        except TypeError:
+            script_key, script_data = None, None
+        if script_data is None:
+            script_data = self._render_script(data, section, add_entrypoint, add_run, prefix)
+            if script_key is not None:
+                self._scripts_cache[script_key] = script_data
+        content, exports, args = script_data
+        self.write_file(file_path, content, executable=True)
+        self.curr_exports.extend(exports)
+        return {key: list(value) for key, value in args.items()}
+
+    def _render_script(self, data, section, add_entrypoint=False, add_run=False, prefix=""):
+        """Render the script of a section
+
+        :return tuple: (content, exports found in the script, copy/run/entrypoint args)
+        """
+        content = "#!/bin/bash\n"
+        for var, value in self.curr_exports:
+            content += "\nexport %s=%s" % (var, value)
+        exports = []
+        for line in data:
+            exports.extend([(var, value) for _, _, var, value in self.re_export.findall(line)])
+            content += "\n" + line
+        if section == "script":
+            for run_at_the_end_script in self.runs_at_the_end_script:
+                content += "\n%s" % run_at_the_end_script
+        src = "./" + os.path.join(prefix, section)
         dest = "/" + section
         args = {
             "copies": [(src, dest)],
             "entrypoints": [dest] if add_entrypoint else [],
             "runs": [dest] if add_run else [],
         }
-        self.chmod_execution(file_path)
-        return args
+        return content, exports, args
 
     def reset(self):
         self.curr_work_path = None
         self.curr_exports = []
+        self._local.manifest = None
+        self._local.changed = False
+        self._local.plan = None
+
+    def load_manifest(self):
+        """Read the manifest of the current work path with the hash of the files generated"""
+        manifest = {"files": {}, "copies": {}}
+        try:
+            with open(os.path.join(self.curr_work_path, self.manifest_fname)) as f_manifest:
+                manifest.update(json.load(f_manifest))
+        except (IOError, OSError, ValueError):  # pylint: disable=except-pass
+            pass
+        self._local.manifest = manifest
+        self._local.changed = False
+
+    def save_manifest(self):
+        if not self._local.changed:
+            return
+        manifest_path = os.path.join(self.curr_work_path, self.manifest_fname)
+        with open(manifest_path + ".tmp", "w") as f_manifest:
+            json.dump(self._local.manifest, f_manifest, sort_keys=True)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    def write_file(self, file_path, content, executable=False):
+        """Write the file only if the content is different than the last one generated
 
-    def compute_build_scripts(self, prefix_build, version):
+        The hash of the content is saved in the manifest of the work path
+        with the stat of the file to detect changes done out of travis2docker.
+        The file is only saved in the plan of the job if it is computed in memory
+        """
+        if self._local.plan is not None:
+            relpath = os.path.relpath(file_path, self.curr_work_path)
+            self._local.plan.files[relpath] = (content, executable)
+            return True
+        content_hash = hashlib.sha1(content.encode("utf-8")).hexdigest()
+        relpath = os.path.relpath(file_path, self.curr_work_path)
+        files = self._local.manifest["files"]
+        try:
+            file_stat = os.stat(file_path)
+        except OSError:
+            file_stat = None
+            self.mkdir_p(os.path.dirname(file_path))
+        if file_stat and files.get(relpath) == [content_hash, file_stat.st_size, file_stat.st_mtime_ns]:
+            return False
+        with open(file_path + ".tmp", "w", encoding="utf-8") as f_tmp:
+            f_tmp.write(content)
+        if file_stat:
+            os.chmod(file_path + ".tmp", stat.S_IMODE(file_stat.st_mode))
+        os.replace(file_path + ".tmp", file_path)
+        if executable:
+            self.chmod_execution(file_path)
+        file_stat = os.stat(file_path)
+        files[relpath] = [content_hash, file_stat.st_size, file_stat.st_mtime_ns]
+        self._local.changed = True
+        return True
+
+    def compute_build_scripts(self, prefix_build, version, cache_volumes=None):
         build_path = os.path.join(self.curr_work_path, "10-build.sh")
         run_path = os.path.join(self.curr_work_path, "20-run.sh")
         new_image = self.new_image + "_" + version.replace(".", "_") + "_" + str(prefix_build)
-        with open(build_path, "w") as f_build, open(run_path, "w") as f_run:
-            build_content = self.build_template.render(
-                image=new_image, dirname_dockerfile=self.curr_work_path, **self.build_extra_params
-            ).strip("\n ")
-            try:
-                f_build.write(build_content.encode("utf-8"))
-            except TypeError:
-                f_build.write(build_content)
-
-            run_content = self.run_template.render(image=new_image, **self.run_extra_params).strip("\n ")
-            try:
-                f_run.write(run_content.encode("utf-8"))
-            except TypeError:
-                f_run.write(run_content)
-        self.chmod_execution(build_path)
-        self.chmod_execution(run_path)
+        if self._local.plan is not None:
+            self._local.plan.image = new_image
+        dirname_dockerfile, target = self.curr_work_path, None
+        if self.multi_stage:
+            # Build the stage of the job from the Dockerfile of its python version
+            dirname_dockerfile, target = os.path.split(self.curr_work_path)
+        build_content = self.build_template.render(
+            image=new_image,
+            dirname_dockerfile=dirname_dockerfile,
+            target=target,
+            buildkit=bool(cache_volumes or self.os_kwargs.get("source_bundle") or self.multi_stage),
+            **self.build_extra_params
+        ).strip("\n ")
+        self.write_file(build_path, build_content, executable=True)
+        # The directories of the build directory are in the image, a volume would hide them
+        volumes = [(name, path) for name, path, in_tree in cache_volumes or [] if not in_tree]
+        run_content = self.run_template.render(image=new_image, volumes=volumes, **self.run_extra_params).strip("\n ")
+        self.write_file(run_path, run_content, executable=True)
 
     def _python_version_env(self):
         versions = self.yml.pop("python", {})
@@ -277,11 +712,17 @@ class Travis2Docker:
         if envs:
             self.yml["env"] = envs
 
-    def compute_dockerfile(self, skip_after_success=False):
-        work_paths = []
+    def compute_jobs(self, selected=True):
+        """Expand the matrix of python versions, env and jobs.include
+
+        :param selected bool: Only the jobs selected by `job_selectors`
+        :return list: (version, env_count, job_count, env, job_stage) of each job
+        """
+        jobs = []
         self._transform_yml_matrix2env()
         self._python_version_env()
         jobs_stages = self.yml.pop("jobs", {}).get("include", {})
+        self.travis_stages = self.get_travis_stages(jobs_stages or [{}], self.yml.pop("stages", None) or [])
         for global_version in self._python_versions:
             for count, global_env in enumerate(self._compute("env"), 1):
                 for job_count, job_stage in enumerate(jobs_stages or [{}], 1):
@@ -296,100 +737,531 @@ class Travis2Docker:
                     except KeyError:  # pylint: disable=except-pass
                         pass
                     version = "%s" % version
+                    job = (version, count, job_count, env, job_stage)
+                    # The jobs not selected are skipped but the numbers of the others are the same
+                    if not selected or self.is_job_selected(job):
+                        jobs.append(job)
+        return jobs
 
-                    self.reset()
-                    self.curr_work_path = os.path.join(
-                        self.work_path,
-                        version.replace(".", "_"),
-                        "env_%d_job_%d" % (count, job_count),
-                    )
-                    curr_dockerfile = os.path.join(self.curr_work_path, self.dockerfile)
-                    entryp_path = os.path.join(self.curr_work_path, "files", "entrypoint.sh")
-                    self.mkdir_p(os.path.dirname(entryp_path))
-                    entryp_relpath = os.path.relpath(entryp_path, self.curr_work_path)
-                    rvm_env_path = os.path.join(self.curr_work_path, "files", "rvm_env.sh")
-                    rvm_env_relpath = os.path.relpath(rvm_env_path, self.curr_work_path)
-                    copies = []
-                    for copy_path, dest in self.copy_paths:
-                        copies.append((self.copy_path(copy_path), dest))
-                    self.set_authorized_key()
-                    kwargs = {
-                        "runs": [],
-                        "copies": copies,
-                        "entrypoints": [],
-                        "entrypoint_path": entryp_relpath,
-                        "python_version": version,
-                        "image": self.image,
-                        "env": env,
-                        "packages": [],
-                        "sources": [],
-                        "rvm_env_path": rvm_env_relpath,
-                        "build_env_args": self.build_env_args,
-                        "build_extra_steps": self.build_extra_steps,
-                    }
-                    with open(curr_dockerfile, "w") as f_dockerfile, open(entryp_path, "w") as f_entrypoint, open(
-                        rvm_env_path, "w"
-                    ) as f_rvm:
-                        for section, _ in self._sections.items():
-                            if section == "env":
-                                continue
-                            if skip_after_success and section == "after_success":
-                                continue
-                            # job section replace global one
-                            result = self._compute(section, job_stage)
-                            if not result:
-                                result = self._compute(section)
-                            if not result:
-                                continue
-                            keys_to_extend = (
-                                ["copies", "runs", "entrypoints", "packages", "sources"]
-                                if isinstance(result, dict)
-                                else []
-                            )
-                            for key_to_extend in keys_to_extend:
-                                if key_to_extend in result:
-                                    kwargs[key_to_extend].extend(result[key_to_extend])
-                        kwargs.update(self.os_kwargs)
-                        dockerfile_content = self.dockerfile_template.render(kwargs).strip("\n ")
-                        try:
-                            f_dockerfile.write(dockerfile_content.encode("utf-8"))
-                        except TypeError:
-                            f_dockerfile.write(dockerfile_content)
-                        entrypoint_content = self.entrypoint_template.render(kwargs).strip("\n ")
-                        try:
-                            f_entrypoint.write(entrypoint_content.encode("utf-8"))
-                        except TypeError:
-                            f_entrypoint.write(entrypoint_content)
-                        rvm_env_content = self.jinja_env.get_template("rvm_env.sh").render(kwargs).strip("\n ")
-                        try:
-                            f_rvm.write(rvm_env_content.encode("UTF-8"))
-                        except TypeError:
-                            f_rvm.write(rvm_env_content)
-                    self.compute_build_scripts(count, version)
-                    self.chmod_execution(entryp_path)
-                    work_paths.append(self.curr_work_path)
+    @staticmethod
+    def get_travis_stages(jobs_stages, stages):
+        """Name of the build stage of each job of `jobs.include`
+
+        A job without stage is of the stage of the previous job ("test" by default)
+
+        :param stages list: The `stages` section of the yml with the order of the stages
+        :return list: (order, name) of the stage of each job, sorted as `stages` and then as the jobs
+        """
+        travis_stages = []
+        stage = "test"
+        for job_stage in jobs_stages:
+            stage = "%s" % job_stage.get("stage") if job_stage.get("stage") else stage
+            travis_stages.append(stage)
+        stages_order = ["%s" % (stage.get("name") if isinstance(stage, dict) else stage) for stage in stages]
+        stages_order += [stage for stage in travis_stages if stage not in stages_order]
+        return [(stages_order.index(stage), stage) for stage in travis_stages]
+
+    def is_job_selected(self, job):
+        """Check the job with `job_selectors`, a dict with the optional keys:
+
+        - python: List of python versions e.g. ["3.8"]
+        - env: List of numbers of env e.g. [1, 3]
+        - job: List of numbers of jobs.include e.g. [2]
+        - vars: List of (variable, regex) all of them matching the value of the variable of the env
+        """
+        version, count, job_count, env = job[:4]
+        selectors = self.job_selectors
+        if selectors.get("python") and version not in selectors["python"]:
+            return False
+        if selectors.get("env") and count not in selectors["env"]:
+            return False
+        if selectors.get("job") and job_count not in selectors["job"]:
+            return False
+        if selectors.get("vars"):
+            try:
+                env_items = shlex.split(env)
+            except ValueError:  # e.g. quotes not closed
+                env_items = env.split()
+            env_vars = dict(env_item.split("=", 1) for env_item in env_items if "=" in env_item)
+            for var, regex in selectors["vars"]:
+                if var not in env_vars or not re.fullmatch(regex, env_vars[var]):
+                    return False
+        return True
+
+    def compute_dockerfile(self, skip_after_success=False, workers=None):
+        """Generate the scripts of each job
+
+        :param workers int: Number of processes rendering the jobs at the same time, by default one by one.
+            The files are written by this process in the serial order, the output is the same than the serial mode
+        :return list: The work path of each job.
+            The jobs with files updated are saved in `changed_work_paths`
+            and the jobs identical to other one (with `dedup`) in `job_aliases`
+        """
+        matrix_jobs = self.compute_jobs(selected=False)
+        jobs = selected_jobs = [job for job in matrix_jobs if self.is_job_selected(job)]
+        self.changed_work_paths = []
+        self._job_stages = {}
+        self.job_aliases = collections.OrderedDict()
+        if len(jobs) > 1 and (self.dedup or workers and workers > 1):
+            # The jobs are rendered in memory and written in the serial order to get the same result,
+            # e.g. a job with its own python version could use the same work path of other job
+            plans = self.compute_plans(jobs, skip_after_success, workers)
+            if self.dedup:
+                jobs, plans = self.dedup_jobs(jobs, plans)
+            work_paths = [self.write_plan(plan) for plan in plans]
+        else:
+            work_paths = [self.compute_job(job, skip_after_success) for job in jobs]
+        if self.job_aliases:
+            self.link_job_aliases()
+            work_paths = [self.get_job_work_path(job) for job in selected_jobs]
+        # The jobs not selected generated before are kept in the stages and in build-all.sh
+        selected_work_paths = {self.get_job_work_path(job) for job in selected_jobs}
+        other_jobs = [
+            job
+            for job in matrix_jobs
+            if self.get_job_work_path(job) not in selected_work_paths
+            and os.path.isdir(self.get_job_work_path(job))
+            and not os.path.islink(self.get_job_work_path(job))
+        ]
+        bases = []
+        if self.multi_stage:
+            # Their 10-build.sh use the stages
+            for job in other_jobs:
+                self._job_stages[self.get_job_work_path(job)] = self.compute_job(
+                    job, skip_after_success, plan=True
+                ).stages
+            bases = self.compute_stages(jobs + other_jobs)
+        if jobs:
+            self.compute_build_all(jobs + other_jobs, bases)
+        changed_work_paths = set(self.changed_work_paths)
+        self.changed_work_paths = [
+            work_path for work_path in collections.OrderedDict.fromkeys(work_paths) if work_path in changed_work_paths
+        ]
         self.reset()
         return work_paths
 
+    def dedup_jobs(self, jobs, plans):
+        """Keep only the first job of the jobs with the same build context, the others are saved in `job_aliases`
+        {work path: work path of the job generated}
+
+        The hash of the files of the jobs rendered in memory is compared
+
+        :param plans list: The JobPlan of each job
+        :return tuple: (jobs, plans) to generate
+        """
+        plans_by_path = collections.OrderedDict()
+        for job, plan in zip(jobs, plans):
+            # The last job of a work path is the one generated
+            plans_by_path[self.get_job_work_path(job)] = (job, plan)
+        work_paths_by_hash = {}
+        unique_jobs, unique_plans = [], []
+        for work_path, (job, plan) in plans_by_path.items():
+            content_hash = plan.get_content_hash()
+            if content_hash in work_paths_by_hash:
+                self.job_aliases[work_path] = work_paths_by_hash[content_hash]
+                continue
+            work_paths_by_hash[content_hash] = work_path
+            unique_jobs.append(job)
+            unique_plans.append(plan)
+        return unique_jobs, unique_plans
+
+    def link_job_aliases(self):
+        """Replace the work path of each alias by a symlink to the work path of the job generated"""
+        for work_path, job_work_path in self.job_aliases.items():
+            link = os.path.relpath(job_work_path, os.path.dirname(work_path))
+            if os.path.islink(work_path):
+                if os.readlink(work_path) == link:
+                    continue
+                os.remove(work_path)
+            elif os.path.isdir(work_path):
+                shutil.rmtree(work_path)
+            self.mkdir_p(os.path.dirname(work_path))
+            os.symlink(link, work_path)
+
+    def compute_plan(self, skip_after_success=False):
+        """Render the jobs in memory, nothing is written in the work path
+
+        :return list: The JobPlan of each job
+        """
+        return self.compute_plans(self.compute_jobs(), skip_after_success)
+
+    def compute_plans(self, jobs, skip_after_success=False, workers=None):
+        """Render the jobs in memory, by other processes with `workers` (the rendering uses the CPU and the GIL)
+
+        :return list: The JobPlan of each job in the same order
+        """
+        if not workers or workers <= 1 or len(jobs) <= 1:
+            plans = [self.compute_job(job, skip_after_success, plan=True) for job in jobs]
+            self.reset()
+            return plans
+        self.get_pub_key()  # Read only once instead of by process
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_render_process, initargs=(self,)) as pool:
+            return list(pool.map(render_job, jobs, itertools.repeat(skip_after_success), chunksize=8))
+
+    def get_job_work_path(self, job):
+        version, count, job_count = job[:3]
+        return os.path.join(self.work_path, version.replace(".", "_"), "env_%d_job_%d" % (count, job_count))
+
+    def compute_job(self, job, skip_after_success=False, plan=False):
+        """Generate the Dockerfile and scripts of a job of the matrix
+
+        :param plan bool: Render the job in memory instead of write it in the work path
+        :return str: The work path of the job or its JobPlan
+        """
+        version, count, _, env, job_stage = job
+        self.reset()
+        self.curr_work_path = self.get_job_work_path(job)
+        if plan:
+            self._local.plan = JobPlan(os.path.relpath(self.curr_work_path, self.work_path), version, env)
+        else:
+            if os.path.islink(self.curr_work_path):
+                # It was an alias of other job generated with `dedup`
+                os.remove(self.curr_work_path)
+            self.load_manifest()
+            self.mkdir_p(self.curr_work_path)
+        curr_dockerfile = os.path.join(self.curr_work_path, self.dockerfile)
+        entryp_path = os.path.join(self.curr_work_path, "files", "entrypoint.sh")
+        entryp_relpath = os.path.relpath(entryp_path, self.curr_work_path)
+        rvm_env_path = os.path.join(self.curr_work_path, "files", "rvm_env.sh")
+        rvm_env_relpath = os.path.relpath(rvm_env_path, self.curr_work_path)
+        copies = []
+        for copy_path, dest in self.copy_paths:
+            copies.append((self.copy_path(copy_path), dest))
+        self.set_authorized_key()
+        kwargs = {
+            "runs": [],
+            "copies": copies,
+            "entrypoints": [],
+            "entrypoint_path": entryp_relpath,
+            "python_version": version,
+            "image": self.image,
+            "env": env,
+            "packages": [],
+            "sources": [],
+            "rvm_env_path": rvm_env_relpath,
+            "build_env_args": self.build_env_args,
+            "build_extra_steps": self.build_extra_steps,
+            "cache_dirs": [],
+        }
+        for section, _ in self._sections.items():
+            if section == "env":
+                continue
+            if skip_after_success and section == "after_success":
+                continue
+            # job section replace global one
+            result = self._compute(section, job_stage)
+            if not result:
+                result = self._compute(section)
+            if not result:
+                continue
+            keys_to_extend = (
+                ["copies", "runs", "entrypoints", "packages", "sources", "cache_dirs"]
+                if isinstance(result, dict)
+                else []
+            )
+            for key_to_extend in keys_to_extend:
+                if key_to_extend in result:
+                    kwargs[key_to_extend].extend(result[key_to_extend])
+        kwargs.update(self.os_kwargs)
+        cache_volumes = self.get_cache_volumes(kwargs["cache_dirs"])
+        # Options of the RUN steps to use the cache mounts of BuildKit, only apt needs exclusive access
+        cache_mounts, cache_restore, cache_save = [], [], []
+        for name, path, in_tree in cache_volumes:
+            target = path
+            if in_tree:
+                target = posixpath.join(self.cache_tree_path, name)
+                cache_restore.append("mkdir -p %s && cp -a %s/. %s && " % (path, target, path))
+                cache_save.append(" && find %s -mindepth 1 -delete && cp -a %s/. %s" % (target, path, target))
+            sharing = ",sharing=locked" if path in self.cache_dirs["apt"] else ""
+            cache_mounts.append("--mount=type=cache,id=%s,target=%s%s,mode=0777 " % (name, target, sharing))
+        kwargs.update(
+            cache_mounts="".join(cache_mounts), cache_restore="".join(cache_restore), cache_save="".join(cache_save)
+        )
+        dockerfile_content = self.dockerfile_template.render(kwargs).strip("\n ")
+        self.write_file(curr_dockerfile, dockerfile_content)
+        entrypoint_content = self.entrypoint_template.render(kwargs).strip("\n ")
+        self.write_file(entryp_path, entrypoint_content, executable=True)
+        rvm_env_content = self.get_template("rvm_env.sh").render(kwargs).strip("\n ")
+        self.write_file(rvm_env_path, rvm_env_content)
+        self.compute_build_scripts(count, version, cache_volumes)
+        if plan:
+            if self.multi_stage:
+                self._local.plan.stages = self.compute_job_stages(kwargs)
+            return self._local.plan
+        if self.multi_stage:
+            self._job_stages[self.curr_work_path] = self.compute_job_stages(kwargs)
+        if self._local.changed:
+            self.changed_work_paths.append(self.curr_work_path)
+        self.save_manifest()
+        return self.curr_work_path
+
+    def compute_job_stages(self, kwargs):
+        """Render the base and the job stages of the current job for the Dockerfile of its python version
+
+        The sources of the COPY are relative to the directory of the python version
+
+        :return tuple: (base to compare, base, job stage, image, the syntax of BuildKit is used)
+        """
+        job_dir = os.path.basename(self.curr_work_path)
+
+        def job_src(src):
+            return posixpath.join(job_dir, posixpath.normpath(src))
+
+        stage_kwargs = dict(
+            kwargs,
+            copies=[(job_src(src), dest) for src, dest in kwargs["copies"]],
+            entrypoint_path=job_src(kwargs["entrypoint_path"]),
+            rvm_env_path=job_src(kwargs["rvm_env_path"]),
+        )
+        # The base is compared without the directory of the job, the files copied are the same for all the jobs
+        base_key = self.get_template("Dockerfile_layered_base").render(kwargs)
+        return (
+            base_key,
+            self.get_template("Dockerfile_layered_base").render(stage_kwargs),
+            self.get_template("Dockerfile_layered_job").render(stage_kwargs),
+            kwargs["image"],
+            bool(kwargs["cache_mounts"] or kwargs.get("source_bundle")),
+        )
+
+    def compute_stages(self, jobs):
+        """Write a multi-stage Dockerfile for each python version
+
+        The jobs with the same base (FROM, packages, copies, the clone of the repo, the env and the install steps)
+        use the same stage `base_N` and each job has its own stage with its entrypoint named as the directory
+        of the job.
+
+        :return list: (version path, base stage) of each base
+        """
+        bases_built = []
+        versions = collections.OrderedDict()
+        # The order of the stages is the number of env and job, a job with its own python version is mixed
+        for job in sorted(jobs, key=lambda job: job[1:3]):
+            work_path = self.get_job_work_path(job)
+            version_work_paths = versions.setdefault(os.path.dirname(work_path), [])
+            if work_path not in version_work_paths:
+                version_work_paths.append(work_path)
+        for version_path, version_work_paths in versions.items():
+            bases = collections.OrderedDict()
+            base_stages, job_stages = [], []
+            syntax = False
+            for work_path in version_work_paths:
+                base_key, base_content, job_content, image, job_syntax = self._job_stages[work_path]
+                syntax = syntax or job_syntax
+                base_name = bases.get((image, base_key))
+                if base_name is None:
+                    base_name = bases[(image, base_key)] = "base_%d" % (len(bases) + 1)
+                    bases_built.append((version_path, base_name))
+                    base_stages.append("FROM %s AS %s%s" % (image, base_name, base_content))
+                job_stages.append("FROM %s AS %s%s" % (base_name, os.path.basename(work_path), job_content))
+            content = "\n".join(base_stages + job_stages)
+            if syntax:
+                content = "# syntax=docker/dockerfile:1\n" + content
+            self.write_shared_file(version_path, self.dockerfile, content)
+        self._job_stages = {}
+        return bases_built
+
+    def compute_build_all(self, jobs, bases):
+        """Generate the script build-all.sh in the work path to build the images of all the jobs
+
+        The jobs are the selected ones and the jobs generated before, so a selector does not remove them.
+        The bases of the multi-stage Dockerfiles are built first, then the stages of travis in order
+        building the jobs of the same stage at the same time
+        """
+        stages = collections.OrderedDict()
+        work_paths = set()
+        jobs_paths = [(self.get_job_work_path(job), job) for job in jobs]
+        jobs_paths.sort(key=lambda job_path: (self.travis_stages[job_path[1][2] - 1][0], job_path[0]))
+        for work_path, job in jobs_paths:
+            if work_path in work_paths:
+                continue
+            work_paths.add(work_path)
+            stage = self.travis_stages[job[2] - 1][1]
+            stages.setdefault(stage, []).append(shlex.quote(os.path.relpath(work_path, self.work_path)))
+        build_all_content = (
+            self.get_template("build-all.sh")
+            .render(
+                bases=[
+                    (shlex.quote(os.path.relpath(version_path, self.work_path)), base) for version_path, base in bases
+                ],
+                buildkit=self.multi_stage,
+                stages=[(shlex.quote(stage), stage_work_paths) for stage, stage_work_paths in stages.items()],
+                summary="build-summary.tsv",
+                logs="build-logs",
+                extra_params=self.build_extra_params.get("extra_params", ""),
+            )
+            .strip("\n ")
+        )
+        self.write_shared_file(self.work_path, "build-all.sh", build_all_content, executable=True)
+
+    def write_shared_file(self, path, fname, content, executable=False):
+        """Write a file shared by the jobs, e.g. in the directory of a python version"""
+        self.reset()
+        self.curr_work_path = path
+        self.load_manifest()
+        self.write_file(os.path.join(path, fname), content, executable)
+        self.save_manifest()
+
+    def write_plan(self, plan):
+        """Write the files of a job rendered in memory, e.g. by other process
+
+        :return str: The work path of the job
+        """
+        self.reset()
+        self.curr_work_path = os.path.join(self.work_path, plan.name)
+        if os.path.islink(self.curr_work_path):
+            os.remove(self.curr_work_path)
+        self.load_manifest()
+        self.mkdir_p(self.curr_work_path)
+        for src, _ in plan.copies:
+            self.copy_path(src)
+        for relpath, (content, executable) in plan.files.items():
+            self.write_file(os.path.join(self.curr_work_path, relpath), content, executable)
+        if plan.stages:
+            self._job_stages[self.curr_work_path] = plan.stages
+        if self._local.changed:
+            self.changed_work_paths.append(self.curr_work_path)
+        self.save_manifest()
+        return self.curr_work_path
+
     def copy_path(self, path):
         """:param paths list: List of paths to copy"""
         src = os.path.expandvars(os.path.expanduser(path))
         basename = os.path.basename(src)
         dest_path = os.path.expandvars(os.path.expanduser(os.path.join(self.curr_work_path, basename)))
+        relpath = os.path.relpath(dest_path, self.curr_work_path)
+        if self._local.plan is not None:
+            if not os.path.isdir(src) and not os.path.isfile(src):
+                raise UserWarning("Just directory or file is supported to copy [%s]" % src)
+            self._local.plan.copies.append((src, relpath))
+            return relpath
+        src_signature = self.get_path_signature(src)
+        copies = self._local.manifest["copies"]
+        if os.path.exists(dest_path) and copies.get(relpath) == src_signature:
+            return relpath
         if os.path.isdir(dest_path):
             shutil.rmtree(dest_path)
+        elif os.path.isfile(dest_path):
+            os.remove(dest_path)
+        if not os.path.isdir(src) and not os.path.isfile(src):
+            raise UserWarning("Just directory or file is supported to copy [%s]" % src)
+        copy_file, copy_dir_file = shutil.copy, shutil.copy2
+        if src == self.os_kwargs.get("source_bundle_path"):
+            # The bundle of the revision is replaced instead of modified, it is linked as is
+            copy_file = self.link_or_copy
+        elif self.stage_path:
+            # Link the files of the copy in the staging area instead of copy them for each job
+            src = self.stage_copy(src, src_signature)
+            copy_file = copy_dir_file = self.link_or_copy
         if os.path.isdir(src):
             try:
-                shutil.copytree(src, dest_path)
+                shutil.copytree(src, dest_path, copy_function=copy_dir_file)
             except shutil.Error:  # pylint: disable=except-pass
                 pass  # There are permissions errors to copy
-        elif os.path.isfile(src):
-            shutil.copy(src, dest_path)
         else:
-            raise UserWarning("Just directory or file is supported to copy [%s]" % src)
-        return os.path.relpath(dest_path, self.curr_work_path)
+            copy_file(src, dest_path)
+        copies[relpath] = src_signature
+        self._local.changed = True
+        return relpath
 
-    def set_authorized_key(self):
+    @staticmethod
+    def get_path_signature(path, max_hash_size=1024 * 1024):
+        """Hash of the name, size and modification time of the files of a path
+
+        The content of the files up to `max_hash_size` bytes is hashed too (e.g. ~/.ssh and the rcfiles),
+        a file rewritten with the same size and mtime has a new signature. For bigger files it is used the
+        inode, the source bundle is replaced with a new file instead of modified.
+        """
+        signature = hashlib.sha1()
+        paths = [path]
+        if os.path.isdir(path):
+            for dirpath, dirnames, fnames in os.walk(path):
+                dirnames.sort()
+                paths.extend(os.path.join(dirpath, fname) for fname in sorted(fnames))
+        for sub_path in paths:
+            try:
+                path_stat = os.stat(sub_path)
+            except OSError:
+                continue
+            path_data = "%s %d %d %o\n" % (sub_path, path_stat.st_size, path_stat.st_mtime_ns, path_stat.st_mode)
+            signature.update(path_data.encode("utf-8"))
+            if not stat.S_ISREG(path_stat.st_mode):
+                continue
+            if path_stat.st_size > max_hash_size:
+                signature.update(b"%d\n" % path_stat.st_ino)
+                continue
+            try:
+                with open(sub_path, "rb") as f_path:
+                    signature.update(hashlib.sha1(f_path.read()).digest())
+            except OSError:
+                continue
+        return signature.hexdigest()
+
+    @staticmethod
+    def link_or_copy(src, dest):
+        try:
+            os.link(src, dest)
+        except OSError:
+            # e.g. other file system or links not supported
+            shutil.copy2(src, dest)
+
+    def stage_copy(self, src, src_signature):
+        """Copy the source path to the staging area once for each signature of its content
+
+        :return str: The path of the copy in the staging area
+        """
+        stage_dir = os.path.join(self.stage_path, src_signature)
+        stage_src = os.path.join(stage_dir, os.path.basename(src))
+        if os.path.exists(stage_src):
+            os.utime(stage_dir)
+            return stage_src
+        self.mkdir_p(self.stage_path)
+        tmp_dir = mkdtemp(prefix=".tmp_", dir=self.stage_path)
+        if os.path.isdir(src):
+            try:
+                shutil.copytree(src, os.path.join(tmp_dir, os.path.basename(src)))
+            except shutil.Error:  # pylint: disable=except-pass
+                pass  # There are permissions errors to copy
+        elif os.path.isfile(src):
+            shutil.copy(src, os.path.join(tmp_dir, os.path.basename(src)))
+        try:
+            os.rename(tmp_dir, stage_dir)
+        except OSError:
+            # Other job or process staged the same content
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return stage_src
+
+    def gc_stage(self, min_age=3600):
+        """Remove the copies of the staging area without links from the jobs
+
+        :param min_age int: Seconds since the last use of a copy to remove it,
+            a copy just staged could be linked by other process yet
+        :return int: Number of copies removed
+        """
+        if not self.stage_path or not os.path.isdir(self.stage_path):
+            return 0
+        removed = 0
+        now = time.time()
+        for stage_name in os.listdir(self.stage_path):
+            stage_dir = os.path.join(self.stage_path, stage_name)
+            try:
+                if now - os.stat(stage_dir).st_mtime < min_age:
+                    continue
+                linked = any(
+                    os.stat(os.path.join(dirpath, fname)).st_nlink > 1
+                    for dirpath, _, fnames in os.walk(stage_dir)
+                    for fname in fnames
+                )
+            except OSError:
+                continue
+            if not linked:
+                shutil.rmtree(stage_dir, ignore_errors=True)
+                removed += 1
+        return removed
+
+    def get_pub_key(self):
+        """Content of the public key of the user, read only once for all the jobs"""
+        if self._pub_key is not None:
+            return self._pub_key
         ssh_dir = os.path.expanduser("~/.ssh")
         ed_key = os.path.join(ssh_dir, "id_ed25519.pub")
         rsa_key = os.path.join(ssh_dir, "id_rsa.pub")
@@ -403,14 +1275,28 @@ class Travis2Docker:
 
         if not to_copy:
             print("No public key found. No key added to ~/.ssh/authorized_keys. SSH login won't work.")
-            return
+            self._pub_key = ""
+            return self._pub_key
 
         with open(to_copy, encoding="utf-8") as key_fd:
-            pub_key = key_fd.read()
-
-        with open(
-            os.path.join(self.curr_work_path, ".ssh", "authorized_keys"),
-            "a",
-            encoding="utf-8",
-        ) as auth_fd:
-            auth_fd.write(pub_key)
+            self._pub_key = key_fd.read()
+        return self._pub_key
+
+    def set_authorized_key(self):
+        pub_key = self.get_pub_key()
+        if not pub_key:
+            return
+
+        auth_path = os.path.join(self.curr_work_path, ".ssh", "authorized_keys")
+        auth_keys = ""
+        read_path = auth_path
+        if self._local.plan is not None:
+            # The file of the job is not copied yet, use the source path of the copy
+            ssh_srcs = [src for src, relpath in self._local.plan.copies if relpath == ".ssh"]
+            read_path = os.path.join(ssh_srcs[-1], "authorized_keys") if ssh_srcs else None
+        if read_path and os.path.isfile(read_path):
+            with open(read_path, encoding="utf-8") as auth_fd:
+                auth_keys = auth_fd.read()
+        # The key was already added if the copy of ~/.ssh was not updated
+        if not auth_keys.endswith(pub_key):
+            self.write_file(auth_path, auth_keys + pub_key)
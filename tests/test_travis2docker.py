@@ -1,11 +1,21 @@
 # No logger planned to use here
 # pylint: disable=print-used,consider-using-with
 
+import io
 import os
 import subprocess
 import sys
+import tarfile
+import threading
+import time
 
+import pytest
+
+from travis2docker import cli, travis2docker
 from travis2docker.cli import main as cli_main
+from travis2docker.exceptions import InvalidRepoBranchError
+from travis2docker.git_run import GitRun
+from travis2docker.travis2docker import Travis2Docker
 
 try:
     from shutil import which  # python3.x
@@ -154,3 +164,975 @@ def test_main():
             "ENV BUILD_ENV2=$BUILD_ENV2",
         ],
     )
+
+
+def git_cmd(path, *args, **env):
+    env = dict(
+        os.environ,
+        GIT_AUTHOR_NAME="t2d",
+        GIT_AUTHOR_EMAIL="t2d@example.com",
+        GIT_COMMITTER_NAME="t2d",
+        GIT_COMMITTER_EMAIL="t2d@example.com",
+        **env
+    )
+    return subprocess.check_output(["git", "-C", str(path)] + list(args), env=env).decode("UTF-8").strip()
+
+
+def create_git_repo(path, files=None):
+    """Create a repository with a commit for `main` and one for `pull/1`"""
+    if files is None:
+        files = {".travis.yml": "install:\n  - touch install\n", "variables.sh": "export MAIN_APP=app\n"}
+    os.makedirs(str(path))
+    git_cmd(path, "init", "-q", "-b", "main")
+    for fname, content in files.items():
+        if os.path.dirname(fname):
+            os.makedirs(os.path.join(str(path), os.path.dirname(fname)), exist_ok=True)
+        with open(os.path.join(str(path), fname), "w") as f_file:
+            f_file.write(content)
+    git_cmd(path, "add", "-A")
+    git_cmd(path, "commit", "-qm", "main")
+    git_cmd(path, "commit", "-q", "--allow-empty", "-m", "pull")
+    git_cmd(path, "update-ref", "refs/pull/1/head", "HEAD")
+    git_cmd(path, "reset", "-q", "--hard", "HEAD~1")
+    return "file://%s" % path
+
+
+def test_git_run_cat_file(tmp_path):
+    url = create_git_repo(tmp_path / "src")
+    git_obj = GitRun(url, str(tmp_path / "repo"), path_prefix_repo=True)
+    # Nothing cloned yet: missing objects instead of errors
+    assert git_obj.get_sha("main") == ""
+    assert git_obj.show_file(".travis.yml", "main") is None
+    git_obj.update()
+    with git_obj:
+        assert git_obj.get_sha("main") == git_cmd(tmp_path / "src", "rev-parse", "main")
+        assert git_obj.get_sha("pull/1") == git_cmd(tmp_path / "src", "rev-parse", "refs/pull/1/head")
+        assert git_obj.get_sha("missing-branch") == ""
+        files = git_obj.show_files([".travis.yml", ".t2d.yml", "variables.sh", ""], "main")
+        assert files == {
+            ".travis.yml": "install:\n  - touch install\n",
+            ".t2d.yml": None,
+            "variables.sh": "export MAIN_APP=app\n",
+            "": None,
+        }
+        assert git_obj.show_file("variables.sh", "pull/1") == "export MAIN_APP=app\n"
+        # The same session is reused by all the reads
+        assert len(set(id(git_obj._cat_file.start()) for _ in range(3))) == 1
+
+
+def test_git_run_update_targeted(tmp_path):
+    url = create_git_repo(tmp_path / "src")
+    mirror_full = GitRun(url, str(tmp_path / "full"))
+    mirror_targeted = GitRun(url, str(tmp_path / "targeted"))
+    for mirror in (mirror_full, mirror_targeted):
+        assert mirror.update()["strategy"] == "full"
+    # New commits in the remote for many branches and pull requests
+    for count in range(5):
+        with open(os.path.join(str(tmp_path / "src"), "file_%d" % count), "w") as f_file:
+            f_file.write("content %d\n" % count * 1000)
+        git_cmd(tmp_path / "src", "add", "-A")
+        git_cmd(tmp_path / "src", "commit", "-qm", "commit %d" % count)
+        git_cmd(tmp_path / "src", "update-ref", "refs/heads/branch_%d" % count, "HEAD")
+        git_cmd(tmp_path / "src", "update-ref", "refs/pull/%d/head" % (count + 10), "HEAD")
+    new_sha = git_cmd(tmp_path / "src", "rev-parse", "HEAD")
+
+    stats_full = mirror_full.update()
+    stats_targeted = mirror_targeted.update("pull/14")
+    assert stats_full["strategy"] == "full"
+    assert stats_full["refs"] == 11
+    assert stats_targeted == {"strategy": "targeted", "refs": 1, "bytes": stats_targeted["bytes"], "fetched": True}
+    assert 0 < stats_targeted["bytes"] <= stats_full["bytes"]
+    assert mirror_targeted.get_sha("pull/14") == new_sha
+    assert mirror_targeted.get_sha("branch_4") == ""
+
+    assert mirror_targeted.update("branch_0")["refs"] == 1
+    # It is not a branch or pull request so it falls back to a full fetch
+    assert mirror_targeted.update("unknown")["strategy"] == "full"
+    assert mirror_targeted.get_sha("branch_4") == new_sha
+
+
+def test_git_run_partial_clone(tmp_path):
+    files = {".travis.yml": "install:\n  - touch install\n", "sub/variables.sh": "export MAIN_APP=app\n"}
+    files.update({"big_%d" % count: os.urandom(100000).hex() for count in range(5)})
+    url = create_git_repo(tmp_path / "src", files)
+    git_cmd(tmp_path / "src", "config", "uploadpack.allowFilter", "true")
+    mirror_full = GitRun(url, str(tmp_path / "full"))
+    mirror_full.update()
+    for partial_filter in ("tree:0", "blob:none"):
+        mirror_partial = GitRun(url, str(tmp_path / partial_filter), partial_clone=partial_filter)
+        mirror_partial.update()
+        assert mirror_partial.is_partial_clone()
+        assert not mirror_full.is_partial_clone()
+        assert mirror_partial.get_objects_size() * 10 < mirror_full.get_objects_size()
+        for mirror in (mirror_full, mirror_partial):
+            with mirror:
+                assert mirror.get_sha("pull/1") == git_cmd(tmp_path / "src", "rev-parse", "refs/pull/1/head")
+                assert mirror.show_files([".travis.yml", "sub/variables.sh", "missing.yml"], "pull/1") == {
+                    ".travis.yml": files[".travis.yml"],
+                    "sub/variables.sh": files["sub/variables.sh"],
+                    "missing.yml": None,
+                }
+        # Only the files read were fetched
+        assert mirror_partial.get_objects_size() * 10 < mirror_full.get_objects_size()
+
+
+def test_git_run_max_age_offline(tmp_path):
+    url = create_git_repo(tmp_path / "src")
+    mirror = GitRun(url, str(tmp_path / "repo"), path_prefix_repo=True)
+    assert mirror.get_fetch_age("main") is None
+    assert mirror.update("main", max_age=3600)["strategy"] == "targeted"
+    old_sha = mirror.get_sha("main")
+    git_cmd(tmp_path / "src", "commit", "-q", "--allow-empty", "-m", "new")
+    new_sha = git_cmd(tmp_path / "src", "rev-parse", "HEAD")
+
+    assert mirror.get_fetch_age("main") < 3600
+    assert mirror.update("main", max_age=3600)["strategy"] == "fresh"
+    assert mirror.get_sha("main") == old_sha
+    assert mirror.update("main", max_age=0)["strategy"] == "targeted"
+    assert mirror.get_sha("main") == new_sha
+    assert set(mirror.get_fetch_record()) == {"main"}
+    # A full refresh makes fresh all the revisions
+    mirror.update()
+    assert mirror.update("pull/1", max_age=3600)["strategy"] == "fresh"
+
+    offline = GitRun(url, str(tmp_path / "repo"), path_prefix_repo=True, offline=True)
+    assert offline.show_file("variables.sh", "main") == "export MAIN_APP=app\n"
+    assert not offline.fetch(["+refs/heads/*:refs/heads/*"])
+
+    sys.argv = ["travis2docker", url, "pull/1", "--offline", "--root-path", str(tmp_path / "missing")]
+    with pytest.raises(InvalidRepoBranchError):
+        main()
+
+
+def test_git_run_concurrent_update(tmp_path, monkeypatch):
+    url = create_git_repo(tmp_path / "src")
+    mirror = GitRun(url, str(tmp_path / "repo"), path_prefix_repo=True)
+    # The fetch does not run the auto maintenance of git, the mirrors are repacked by the maintenance command
+    monkeypatch.setenv("GIT_TRACE", str(tmp_path / "git_trace.log"))
+    mirror.update("main")
+    monkeypatch.delenv("GIT_TRACE")
+    with open(str(tmp_path / "git_trace.log")) as f_trace:
+        trace = f_trace.read()
+    assert " fetch " in trace
+    assert "maintenance run" not in trace and "gc --auto" not in trace
+    git_cmd(tmp_path / "src", "commit", "-q", "--allow-empty", "-m", "new")
+    results = []
+
+    def update():
+        results.append(GitRun(url, str(tmp_path / "repo"), path_prefix_repo=True).update("main")["strategy"])
+
+    threads = [threading.Thread(target=update) for _ in range(5)]
+    # All the callers wait for the lock of the updater
+    with mirror.lock():
+        for thread in threads:
+            thread.start()
+        time.sleep(0.5)
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == ["coalesced"] * 4 + ["targeted"]
+    assert mirror.get_sha("main") == git_cmd(tmp_path / "src", "rev-parse", "HEAD")
+
+    sys.argv = ["travis2docker", "maintenance", "--root-path", str(tmp_path), "--force"]
+    assert main() == [mirror.path]
+    assert mirror.get_sha("main") == git_cmd(tmp_path / "src", "rev-parse", "HEAD")
+
+
+def test_git_run_iter_ref_data(tmp_path):
+    url = create_git_repo(tmp_path / "src")
+    mirror = GitRun(url, str(tmp_path / "repo"))
+    main_sha = git_cmd(tmp_path / "src", "rev-parse", "main")
+    git_cmd(tmp_path / "src", "checkout", "-q", "refs/pull/1/head")
+    git_cmd(tmp_path / "src", "commit", "-q", "--allow-empty", "-m", "new", GIT_COMMITTER_DATE="2099-01-01T00:00:00")
+    pull_sha = git_cmd(tmp_path / "src", "rev-parse", "HEAD")
+    git_cmd(tmp_path / "src", "update-ref", "refs/pull/1/head", pull_sha)
+    git_cmd(tmp_path / "src", "checkout", "-q", "main")
+    for count in range(3):
+        git_cmd(tmp_path / "src", "update-ref", "refs/heads/1%d.0" % count, main_sha)
+    mirror.update()
+
+    refs = list(mirror.iter_ref_data(["refs/heads/1[0-9].0", "refs/pull/*"], ["objectname"], sort="-committerdate"))
+    # The pull request has the newest commit
+    assert [ref_data.refname for ref_data in refs] == [
+        "refs/pull/1",
+        "refs/heads/10.0",
+        "refs/heads/11.0",
+        "refs/heads/12.0",
+    ]
+    assert refs[0]["objectname"] == pull_sha
+    assert refs[1].get("subject") is None
+    assert not hasattr(refs[0], "__dict__")
+    assert refs[1].fields is refs[2].fields
+
+    assert mirror.get_ref_data(fields=["objectname", "subject"]) == {
+        "refs/heads/main": {"objectname": main_sha, "subject": "main"},
+        "refs/heads/10.0": {"objectname": main_sha, "subject": "main"},
+        "refs/heads/11.0": {"objectname": main_sha, "subject": "main"},
+        "refs/heads/12.0": {"objectname": main_sha, "subject": "main"},
+    }
+    assert mirror.get_ref_data(["refs/tags"]) == {}
+
+
+def test_main_fan_out(tmp_path):
+    url = create_git_repo(tmp_path / "src")
+    for branch in ("10.0", "11.0"):
+        git_cmd(tmp_path / "src", "branch", branch)
+    git_cmd(tmp_path / "src", "checkout", "-q", "-b", "12.0")
+    git_cmd(tmp_path / "src", "rm", "-q", ".travis.yml", "variables.sh")
+    git_cmd(tmp_path / "src", "commit", "-qm", "No config files")
+    argv = ["travis2docker", url, "pull/*,1[0-9].0", "--fan-out", "--root-path", str(tmp_path / "t2d")]
+
+    sys.argv = argv
+    summary = main()
+    assert {revision: res["status"] for revision, res in summary.items()} == {
+        "10.0": "generated",
+        "11.0": "generated",
+        "12.0": "failed",
+        "pull/1": "generated",
+    }
+    assert isinstance(summary["12.0"]["error"], InvalidRepoBranchError)
+    assert summary["pull/1"]["scripts"][0].endswith(os.path.join("pull", "1", "3_5", "env_1_job_1"))
+
+    git_cmd(tmp_path / "src", "checkout", "-q", "11.0")
+    git_cmd(tmp_path / "src", "commit", "-q", "--allow-empty", "-m", "new")
+    sys.argv = argv
+    summary = main()
+    assert {revision: res["status"] for revision, res in summary.items()} == {
+        "10.0": "skipped",
+        "11.0": "generated",
+        "12.0": "failed",
+        "pull/1": "skipped",
+    }
+    # Other options generate all of them again
+    sys.argv = argv + ["--exclude-after-success"]
+    assert all(res["status"] != "skipped" for res in main().values())
+
+    # The content of the file of --travis-yml-path too
+    yml_path = tmp_path / "travis.yml"
+    yml_path.write_text("install:\n  - touch install\n")
+    sys.argv = argv + ["--travis-yml-path", str(yml_path)]
+    main()
+    assert all(res["status"] == "skipped" for res in main().values())
+    yml_path.write_text("install:\n  - touch other\n")
+    assert all(res["status"] == "generated" for res in main().values())
+
+
+def test_git_run_shared_objects(tmp_path):
+    files = {".travis.yml": "install:\n  - touch install\n", "big": os.urandom(200000).hex()}
+    url = create_git_repo(tmp_path / "odoo" / "project", files)
+    fork_url = "file://%s" % (tmp_path / "vauxoo" / "project")
+    git_cmd(tmp_path, "clone", "-q", url, str(tmp_path / "vauxoo" / "project"))
+    git_cmd(tmp_path / "vauxoo" / "project", "commit", "-q", "--allow-empty", "-m", "fork")
+
+    mirror = GitRun(url, str(tmp_path / "repo"), path_prefix_repo=True, shared_objects=True)
+    mirror_fork = GitRun(fork_url, str(tmp_path / "repo"), path_prefix_repo=True, shared_objects=True)
+    mirror_not_shared = GitRun(fork_url, str(tmp_path / "not_shared"), path_prefix_repo=True)
+    for git_obj in (mirror, mirror_fork, mirror_not_shared):
+        git_obj.update("main")
+    shared_store = mirror.get_shared_store()
+    assert shared_store.path == mirror_fork.get_shared_store().path
+    assert mirror_fork.get_alternates() == [os.path.join(shared_store.path, "objects")]
+    assert mirror.get_objects_size() * 10 < mirror_not_shared.get_objects_size()
+    assert mirror_fork.get_objects_size() * 10 < mirror_not_shared.get_objects_size()
+    fork_sha = git_cmd(tmp_path / "vauxoo" / "project", "rev-parse", "HEAD")
+    assert mirror_fork.get_sha("main") == fork_sha
+    assert mirror_fork.show_file("big", "main") == files["big"]
+
+    # The new objects of the fork are moved to the shared store
+    git_cmd(tmp_path / "vauxoo" / "project", "commit", "-q", "--allow-empty", "-m", "new")
+    mirror_fork.update("main")
+    mirror_fork.maintenance(auto=False)
+    fork_sha = git_cmd(tmp_path / "vauxoo" / "project", "rev-parse", "HEAD")
+    assert shared_store.get_sha(fork_sha) == fork_sha
+    assert mirror_fork.get_sha("main") == fork_sha
+    assert mirror_fork.show_file("big", "main") == files["big"]
+    assert mirror_fork.run(["fsck", "--no-dangling"]) is not None
+
+    # The objects of a tag are kept by the shared store after its branch is moved
+    fork_path = tmp_path / "vauxoo" / "project"
+    git_cmd(fork_path, "checkout", "-q", "-b", "old")
+    git_cmd(fork_path, "commit", "-q", "--allow-empty", "-m", "tagged")
+    git_cmd(fork_path, "tag", "v1")
+    tag_sha = git_cmd(fork_path, "rev-parse", "v1")
+    # Fetched as a pack, the objects borrowed from the shared store are removed by the repack of the mirror
+    git_cmd(mirror_fork.path, "config", "fetch.unpackLimit", "1")
+    mirror_fork.update()
+    mirror_fork.maintenance(auto=False)
+    git_cmd(fork_path, "checkout", "-q", "main")
+    git_cmd(fork_path, "branch", "-f", "old", "main")
+    mirror_fork.update()
+    mirror_fork.maintenance(auto=False)
+    shared_store.run(["gc", "--prune=now"])
+    assert mirror_fork.run(["cat-file", "-t", tag_sha]) == "commit\n"
+
+
+def test_main_warm(tmp_path):
+    urls = [create_git_repo(tmp_path / ("src_%d" % count)) for count in range(4)]
+    repos_file = tmp_path / "repos.txt"
+    repos_file.write_text("\n".join(urls + ["# comment", "", "file://%s" % (tmp_path / "missing")]))
+    sys.argv = ["travis2docker", "warm", str(repos_file), "-j", "3", "--root-path", str(tmp_path / "t2d")]
+    summary = main()
+    assert sorted(summary) == sorted(urls + ["file://%s" % (tmp_path / "missing")])
+    assert summary["file://%s" % (tmp_path / "missing")]["status"] == "failed"
+    for count, url in enumerate(urls):
+        assert summary[url]["status"] == "ok"
+        assert summary[url]["seconds"] > 0
+        git_obj = GitRun(url, str(tmp_path / "t2d" / "repo"), path_prefix_repo=True)
+        assert git_obj.get_sha("pull/1") == git_cmd(tmp_path / ("src_%d" % count), "rev-parse", "refs/pull/1/head")
+
+    sys.argv = ["travis2docker", "warm", str(repos_file), "--root-path", str(tmp_path / "t2d"), "--max-age", "3600"]
+    summary = main()
+    assert all(summary[url]["refs"] == 0 for url in urls)
+
+
+def test_main_subcommand_name(tmp_path, capsys):
+    sys.argv = ["travis2docker", "warm", "--help"]
+    with pytest.raises(SystemExit):
+        main()
+    assert capsys.readouterr().out.startswith("usage: travisfile2dockerfile warm ")
+
+    # A repository with the name of a subcommand
+    yml_path = tmp_path / "travis.yml"
+    yml_path.write_text("language: python\n")
+    sys.argv = ["travis2docker", "--no-clone", "--travis-yml-path", str(yml_path), "--root-path", str(tmp_path)]
+    sys.argv += ["--", "warm", "main"]
+    scripts = main()
+    assert scripts[0].startswith(os.path.join(str(tmp_path), "script", GitRun.url2dirname("warm"), "main"))
+
+
+def test_main_source_bundle(tmp_path):
+    url = create_git_repo(
+        tmp_path / "src",
+        {".travis.yml": "addons:\n  apt:\n    packages:\n      - unzip\ninstall:\n  - touch install\n"},
+    )
+    for revision, ref in (("pull/1", "refs/pull/1"), ("main", "refs/heads/main")):
+        sys.argv = ["travis2docker", url, revision, "--source-bundle", "--root-path", str(tmp_path / "t2d")]
+        scripts = main()
+        with open(os.path.join(scripts[0], "Dockerfile")) as f_dkr:
+            dkr_content = f_dkr.read()
+        # The bundle changes with each revision, it is mounted after the steps of apt and only to clone
+        mount = "RUN --mount=type=bind,source=source.bundle,target=/tmp/source.bundle git init"
+        assert dkr_content.startswith("# syntax=docker/dockerfile:1\n")
+        assert dkr_content.index("apt-get install unzip") < dkr_content.index(mount)
+        assert "source.bundle /tmp/source.bundle" not in dkr_content
+        with open(os.path.join(scripts[0], "10-build.sh")) as f_build:
+            assert "export DOCKER_BUILDKIT=1" in f_build.read()
+        # Linked from the directory of the bundles instead of a copy in the staging area
+        bundle_stat = os.stat(os.path.join(scripts[0], "source.bundle"))
+        assert bundle_stat.st_nlink == 2
+        assert "git fetch --update-head-ok /tmp/source.bundle '+%s:%s'" % (ref, ref) in dkr_content
+        assert "git fetch --update-head-ok -p origin" not in dkr_content
+        # Same steps of the Dockerfile using the bundle of the build context
+        build_dir = tmp_path / "build" / revision
+        git_cmd(tmp_path, "init", "-q", str(build_dir))
+        git_cmd(build_dir, "remote", "add", "origin", url)
+        git_cmd(
+            build_dir,
+            "fetch",
+            "-q",
+            "--update-head-ok",
+            os.path.join(scripts[0], "source.bundle"),
+            "+%s:%s" % (ref, ref),
+        )
+        git_cmd(build_dir, "checkout", "-qf", revision)
+        assert git_cmd(build_dir, "rev-parse", "HEAD") == git_cmd(
+            tmp_path / "src", "rev-parse", ref.replace("pull/1", "pull/1/head")
+        )
+        assert git_cmd(build_dir, "remote", "get-url", "origin") == url
+
+    sys.argv = [
+        "travis2docker",
+        url,
+        "main",
+        "--source-bundle",
+        "--layered-dockerfile",
+        "--root-path",
+        str(tmp_path / "t2d"),
+    ]
+    scripts = main()
+    with open(os.path.join(scripts[0], "Dockerfile")) as f_dkr:
+        dkr_content = f_dkr.read()
+    assert dkr_content.startswith("# syntax=docker/dockerfile:1\n")
+    assert "RUN --mount=type=bind,source=source.bundle,target=/tmp/source.bundle git init" in dkr_content
+
+    # The Dockerfile of deployv does not use the bundle
+    url = create_git_repo(
+        tmp_path / "deployv",
+        {"variables.sh": "export MAIN_APP=app\nexport VERSION=14.0\nexport DOCKER_IMAGE_REPO=vauxoo/app\n"},
+    )
+    sys.argv = ["travis2docker", url, "main", "--source-bundle", "--deployv", "--root-path", str(tmp_path / "t2d2")]
+    scripts = main()
+    assert not os.path.exists(os.path.join(scripts[0], "source.bundle"))
+    assert not os.path.exists(str(tmp_path / "t2d2" / "bundle"))
+
+
+def test_main_workers(tmp_path):
+    yml_path = str(tmp_path / "travis.yml")
+    with open(yml_path, "w") as f_yml:
+        f_yml.write(
+            "language: python\npython:\n  - '3.8'\n  - '3.10'\n"
+            "env:\n  - TESTS=1\n  - LINT=1\n"
+            "jobs:\n  include:\n    - python: '3.8'\n      env: EXTRA=1\n"
+            "script:\n  - echo $TESTS\n"
+        )
+
+    def read_tree(root_path):
+        tree = {}
+        for dirpath, _, fnames in os.walk(root_path):
+            for fname in fnames:
+                if fname == Travis2Docker.manifest_fname:
+                    continue
+                fname_path = os.path.join(dirpath, fname)
+                with open(fname_path, "rb") as f_script:
+                    content = f_script.read().replace(root_path.encode(), b"ROOT")
+                tree[os.path.relpath(fname_path, root_path)] = content
+        return tree
+
+    results = {}
+    for workers in ("1", "4"):
+        root_path = str(tmp_path / ("root_%s" % workers))
+        sys.argv = ["travis2docker", "foo", "bar", "--no-clone", "--travis-yml-path", yml_path]
+        sys.argv += ["--root-path", root_path, "--workers", workers]
+        scripts = main()
+        results[workers] = ([os.path.relpath(script, root_path) for script in scripts], read_tree(root_path))
+    # The job with its own python version uses the same work path of other job
+    assert len(results["1"][0]) > len(set(results["1"][0]))
+    assert results["1"] == results["4"]
+
+
+def test_scripts_cache(tmp_path, monkeypatch):
+    yml_path = str(tmp_path / "travis.yml")
+    with open(yml_path, "w") as f_yml:
+        f_yml.write(
+            "language: python\npython:\n  - '3.6'\n  - '3.8'\n  - '3.10'\n"
+            "env:\n  - TESTS=1\n  - LINT=1\n  - DOCS=1\n"
+            "install:\n  - export INSTALLED=1\n"
+            "script:\n  - echo $INSTALLED\n"
+            "jobs:\n  include:\n    - env: JOB=1\n    - script: echo job\n"
+        )
+    rendered = []
+    render_script = Travis2Docker._render_script  # pylint: disable=protected-access
+
+    def _render_script(self, data, section, *args, **kwargs):
+        rendered.append(section)
+        return render_script(self, data, section, *args, **kwargs)
+
+    monkeypatch.setattr(Travis2Docker, "_render_script", _render_script)
+    sys.argv = ["travis2docker", "foo", "bar", "--no-clone", "--travis-yml-path", yml_path]
+    sys.argv += ["--root-path", str(tmp_path / "root")]
+    scripts = main()
+    assert len(scripts) == 3 * 3 * 2
+    # install, script and the script of the job are rendered once for all the matrix
+    assert sorted(rendered) == ["install", "script", "script"]
+    with open(os.path.join(scripts[-1], "files", "script")) as f_script:
+        assert f_script.read() == "#!/bin/bash\n\nexport INSTALLED=1\necho job\nsleep 2"
+
+
+def test_main_unchanged_scripts(tmp_path, monkeypatch):
+    home_path = tmp_path / "home"
+    (home_path / ".ssh").mkdir(parents=True)
+    (home_path / ".ssh" / "id_ed25519.pub").write_text("ssh-ed25519 AAAA user@host\n")
+    monkeypatch.setenv("HOME", str(home_path))
+    yml_path = tmp_path / "travis.yml"
+    yml_path.write_text("language: python\npython:\n  - '3.8'\nenv:\n  - TESTS=1\n  - LINT=1\nscript:\n  - echo 1\n")
+    argv = ["travis2docker", "foo", "bar", "--no-clone", "--travis-yml-path", str(yml_path)]
+    argv += ["--root-path", str(tmp_path / "root")]
+
+    def main_output():
+        output = io.StringIO()
+        monkeypatch.setattr(cli, "stdout", output)
+        sys.argv = argv
+        return main(), output.getvalue()
+
+    def read_mtimes(scripts):
+        return {
+            os.path.join(dirpath, fname): os.stat(os.path.join(dirpath, fname)).st_mtime_ns
+            for script in scripts
+            for dirpath, _, fnames in os.walk(script)
+            for fname in fnames
+        }
+
+    scripts, output = main_output()
+    assert "Changed scripts:" in output
+    mtimes = read_mtimes(scripts)
+    time.sleep(0.01)
+
+    new_scripts, output = main_output()
+    assert new_scripts == scripts
+    assert "No changes in the generated scripts" in output
+    assert read_mtimes(scripts) == mtimes
+    with open(os.path.join(scripts[0], ".ssh", "authorized_keys")) as f_auth:
+        assert f_auth.read() == "ssh-ed25519 AAAA user@host\n"
+
+    yml_path.write_text("language: python\npython:\n  - '3.8'\nenv:\n  - TESTS=1\n  - LINT=0\nscript:\n  - echo 1\n")
+    _, output = main_output()
+    assert "Changed scripts:\n- %s\n" % scripts[1] in output
+    new_mtimes = read_mtimes(scripts)
+    changed_files = sorted(fname for fname in mtimes if mtimes[fname] != new_mtimes[fname])
+    assert changed_files == [
+        os.path.join(scripts[1], Travis2Docker.manifest_fname),
+        os.path.join(scripts[1], "Dockerfile"),
+    ]
+
+
+def test_main_stage_copies(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    (tmp_path / "home" / ".ssh").mkdir(parents=True)
+    rc_path = tmp_path / "rc"
+    rc_path.mkdir()
+    (rc_path / "config").write_text("config 1\n")
+    yml_path = tmp_path / "travis.yml"
+    yml_path.write_text("language: python\npython:\n  - '3.8'\nenv:\n  - TESTS=1\n  - LINT=1\n")
+    root_path = tmp_path / "root"
+    sys.argv = ["travis2docker", "foo", "bar", "--no-clone", "--travis-yml-path", str(yml_path)]
+    sys.argv += ["--root-path", str(root_path), "--add-rcfile", str(rc_path)]
+    argv = sys.argv
+    scripts = main()
+    stage_path = root_path / "stage"
+    assert len(os.listdir(str(stage_path))) == 2  # ~/.ssh and rc
+    # The staged file and the file of each job are the same
+    assert os.stat(os.path.join(scripts[0], "rc", "config")).st_nlink == len(scripts) + 1
+
+    time.sleep(0.01)
+    (rc_path / "config").write_text("config 2\n")
+    sys.argv = argv
+    scripts = main()
+    with open(os.path.join(scripts[1], "rc", "config")) as f_config:
+        assert f_config.read() == "config 2\n"
+    assert len(os.listdir(str(stage_path))) == 3
+    t2d = Travis2Docker("language: python", stage_path=str(stage_path))
+    assert t2d.gc_stage(min_age=0) == 2  # the old rc and ~/.ssh without files
+    assert len(os.listdir(str(stage_path))) == 1
+
+    # Rewritten with the same size and mtime
+    config_stat = os.stat(str(rc_path / "config"))
+    (rc_path / "config").write_text("config X\n")
+    os.utime(str(rc_path / "config"), ns=(config_stat.st_atime_ns, config_stat.st_mtime_ns))
+    sys.argv = argv
+    scripts = main()
+    with open(os.path.join(scripts[1], "rc", "config")) as f_config:
+        assert f_config.read() == "config X\n"
+
+    def link(src, dest):
+        raise OSError("Links not supported")
+
+    (rc_path / "config").write_text("config 3\n")
+    monkeypatch.setattr(os, "link", link)
+    sys.argv = argv
+    scripts = main()
+    with open(os.path.join(scripts[1], "rc", "config")) as f_config:
+        assert f_config.read() == "config 3\n"
+    assert os.stat(os.path.join(scripts[1], "rc", "config")).st_nlink == 1
+
+
+def test_jinja_env_shared(tmp_path):
+    templates_path = tmp_path / "templates"
+    templates_path.mkdir()
+    template_path = templates_path / "rvm_env.sh"
+    template_path.write_text("echo {{ python_version }}")
+    t2d = Travis2Docker("language: python", templates_path=str(templates_path))
+    assert t2d.jinja_env is Travis2Docker("language: python", templates_path=str(templates_path)).jinja_env
+    assert t2d.jinja_env is not Travis2Docker("language: python").jinja_env
+    assert t2d.get_template("rvm_env.sh").render(python_version="3.8") == "echo 3.8"
+
+    template_path.write_text("echo python{{ python_version }}")
+    template_mtime = os.stat(str(template_path)).st_mtime
+    os.utime(str(template_path), (template_mtime + 10, template_mtime + 10))
+    t2d = Travis2Docker("language: python", templates_path=str(templates_path))
+    assert t2d.get_template("rvm_env.sh").render(python_version="3.8") == "echo python3.8"
+
+
+def test_apt_sources(tmp_path, monkeypatch, capsys):
+    whitelist_path = str(tmp_path / "ubuntu.json")
+    cache_path = str(tmp_path / "cache" / "apt_sources.marshal")
+    with open(whitelist_path, "w") as f_whitelist:
+        f_whitelist.write(
+            '[{"alias": "pov-wkhtmltopdf", "sourceline": "ppa:pov/wkhtmltopdf", "key_url": null},'
+            ' {"alias": "other", "sourceline": "deb http://example.com trusty main", "key_url": "http://key"}]'
+        )
+    apt_sources = travis2docker.get_apt_sources(whitelist_path, cache_path)
+    assert apt_sources["other"] == [("http://key", "deb http://example.com trusty main")]
+    assert travis2docker.get_apt_sources(whitelist_path, cache_path) is apt_sources
+
+    # Other process uses the index of the cache without parse the json file
+    monkeypatch.setattr(travis2docker, "APT_SOURCES", {})
+    monkeypatch.setattr(travis2docker.json, "load", None)
+    assert travis2docker.get_apt_sources(whitelist_path, cache_path) == apt_sources
+
+    monkeypatch.setattr(travis2docker, "get_apt_sources", lambda: apt_sources)
+    t2d = Travis2Docker("language: python")
+    addons = {"apt": {"sources": ["pov-wkhtmltopdf", "unknown"], "packages": ["wkhtmltopdf"]}}
+    for _ in range(2):
+        result = t2d._compute_addons(addons, "addons", {})  # pylint: disable=protected-access
+        assert result["sources"] == ['apt-add-repository -y "ppa:pov/wkhtmltopdf"']
+    assert capsys.readouterr().out.count("The apt source unknown is not in the whitelist") == 1
+
+
+def test_cli_startup():
+    """The cli is called many times by other scripts, the time to start should not grow"""
+    loaded = subprocess.check_output(
+        [
+            sys.executable,
+            "-c",
+            "import sys, travis2docker.cli; "
+            "print(sorted({'argparse', 'concurrent.futures', 'jinja2', 'yaml'} & set(sys.modules)))",
+        ]
+    )
+    assert loaded.decode("UTF-8").strip() == "[]"
+
+    def startup_time(cmd, repeat=3):
+        times = []
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.check_output([sys.executable] + cmd)
+            times.append(time.time() - start)
+        return min(times)
+
+    # Seconds over the start of the interpreter, the budget is checked only if the env var is set (e.g. 0.3)
+    # because the wall-clock time depends on the load of the machine
+    budget = os.environ.get("T2D_STARTUP_BUDGET")
+    python_time = startup_time(["-c", "pass"])
+    for cmd in (["--version"], ["--help"]):
+        cmd_time = startup_time(["-m", "travis2docker"] + cmd) - python_time
+        print("Start-up time of %s: %.3fs" % (" ".join(cmd), cmd_time))
+        if budget:
+            assert cmd_time < float(budget), "%s took %.3fs" % (" ".join(cmd), cmd_time)
+
+
+def test_yml_cache(tmp_path, monkeypatch):
+    url = create_git_repo(tmp_path / "src")
+    with GitRun(url, str(tmp_path / "mirror")) as git_obj:
+        git_obj.update("main")
+        git_data = cli.read_git_data(git_obj, "main")
+    assert git_data["content_sha"] == git_cmd(tmp_path / "src", "rev-parse", "main:.travis.yml")
+
+    yaml_load = travis2docker.yaml.load
+    parsed = []
+
+    def load(*args, **kwargs):
+        parsed.append(args[0])
+        return yaml_load(*args, **kwargs)
+
+    monkeypatch.setattr(travis2docker.yaml, "load", load)
+    monkeypatch.setattr(travis2docker, "YML_CACHE", travis2docker.collections.OrderedDict())
+    t2d = Travis2Docker(git_data["content"], yml_key=git_data["content_sha"])
+    t2d.yml["install"].append("touch other")
+    t2d_other = Travis2Docker(git_data["content"], yml_key=git_data["content_sha"])
+    assert len(parsed) == 1
+    # The changes of the yml of an instance are not in the cache
+    assert t2d_other.yml == {"install": ["touch install"]}
+
+
+def test_main_tar_job(tmp_path, monkeypatch):
+    home_path = tmp_path / "home"
+    (home_path / ".ssh").mkdir(parents=True)
+    (home_path / ".ssh" / "id_ed25519.pub").write_text("ssh-ed25519 AAAA user@host\n")
+    (home_path / ".ssh" / "authorized_keys").write_text("ssh-ed25519 BBBB other@host\n")
+    monkeypatch.setenv("HOME", str(home_path))
+    yml_path = tmp_path / "travis.yml"
+    yml_path.write_text("language: python\npython:\n  - '3.8'\nenv:\n  - TESTS=1\n  - LINT=1\nscript:\n  - echo 1\n")
+    root_path = tmp_path / "root"
+    tar_stdout = io.TextIOWrapper(io.BytesIO())
+    monkeypatch.setattr(sys, "stdout", tar_stdout)
+    sys.argv = ["travis2docker", "foo", "bar", "--no-clone", "--travis-yml-path", str(yml_path)]
+    sys.argv += ["--root-path", str(root_path), "--tar-job", "3_8/env_2_job_1"]
+    plan = main()
+    assert plan.name == os.path.join("3_8", "env_2_job_1")
+    assert plan.image == "local_file-local_file:bar_3_8_2"
+    assert not root_path.exists()
+
+    tar_stdout.buffer.seek(0)
+    with tarfile.open(fileobj=tar_stdout.buffer) as tar:
+        names = tar.getnames()
+        assert "Dockerfile" in names
+        assert tar.getmember("files/entrypoint.sh").mode == 0o755
+        assert tar.extractfile("files/script").read() == b"#!/bin/bash\n\necho 1\nsleep 2"
+        assert "LINT=1" in tar.extractfile("Dockerfile").read().decode("UTF-8")
+        # The key is added to the keys of the user only once
+        assert names.count(".ssh/authorized_keys") == 1
+        assert tar.extractfile(".ssh/authorized_keys").read() == (
+            b"ssh-ed25519 BBBB other@host\nssh-ed25519 AAAA user@host\n"
+        )
+
+
+def test_main_only_jobs(tmp_path):
+    yml_path = tmp_path / "travis.yml"
+    yml_path.write_text(
+        "language: python\npython:\n  - '3.8'\n  - '3.10'\n"
+        'env:\n  - TESTS=1 LINT_CHECK=0\n  - TESTS=0 LINT_CHECK=1\n  - TESTS=1 NAME="odoo tests"\n'
+        "jobs:\n  include:\n    - env: JOB=1\n    - env: JOB=2\n"
+    )
+    root_path = tmp_path / "root"
+    argv = ["travis2docker", "foo", "bar", "--no-clone", "--travis-yml-path", str(yml_path)]
+    argv += ["--root-path", str(root_path)]
+    work_path = str(root_path / "script" / "foo" / "bar")
+
+    def main_only(*only_args):
+        sys.argv = argv + list(only_args)
+        return sorted(os.path.relpath(script, work_path) for script in main())
+
+    assert len(main_only()) == 2 * 3 * 2
+    assert main_only("--only-python", "3.10", "--only-env", "2", "3", "--only-job", "2") == [
+        os.path.join("3_10", "env_2_job_2"),
+        os.path.join("3_10", "env_3_job_2"),
+    ]
+    assert main_only("--only", "TESTS=1", "NAME=odoo.*", "JOB=1") == [
+        os.path.join("3_10", "env_3_job_1"),
+        os.path.join("3_8", "env_3_job_1"),
+    ]
+    assert main_only("--only", "LINT_CHECK=[01]", "--only-python", "3.8", "--only-job", "1") == [
+        os.path.join("3_8", "env_1_job_1"),
+        os.path.join("3_8", "env_2_job_1"),
+    ]
+
+
+def test_main_layered_dockerfile(tmp_path):
+    yml = (
+        "language: python\npython:\n  - '3.8'\nenv:\n  - TESTS=1\n"
+        "addons:\n  apt:\n    packages:\n      - unzip\n"
+        "install:\n  - touch install\nscript:\n  - %s\n"
+    )
+    results = {}
+    for layered in ([], ["--layered-dockerfile"]):
+        scripts = []
+        for revision, script in (("rev1", "touch script"), ("rev2", "touch other_script")):
+            yml_path = tmp_path / ("%s.yml" % revision)
+            yml_path.write_text(yml % script)
+            sys.argv = ["travis2docker", "foo", revision, "--no-clone", "--travis-yml-path", str(yml_path)]
+            sys.argv += ["--root-path", str(tmp_path / "root")] + layered
+            scripts.extend(main())
+        sys.argv = ["travis2docker", "diff-layers"] + scripts
+        results[bool(layered)] = main()
+
+    # The file of the script is copied before apt in the default Dockerfile
+    assert results[False]["reason"] == "content"
+    assert results[False]["a"] == "COPY ./files/script /script"
+    # The clone of the revision is the first step different, then the steps of the job
+    assert results[True]["step"] > results[False]["step"]
+    assert results[True]["reason"] == "instruction"
+    assert results[True]["a"].startswith("RUN git init")
+    with open(os.path.join(scripts[0], "Dockerfile")) as f_dockerfile:
+        steps = travis2docker.get_dockerfile_steps(f_dockerfile.read())
+    assert steps.index("RUN apt-get update; apt-get install unzip") < steps.index(results[True]["a"])
+    assert steps[-2] == "COPY --chown=odoo:odoo ./files/script /script"
+
+
+def test_main_cache_mounts(tmp_path):
+    yml_path = tmp_path / "travis.yml"
+    yml_path.write_text(
+        "language: python\npython:\n  - '3.8'\n"
+        "cache:\n  apt: true\n  directories:\n    - $HOME/.cache/pip\n    - node_modules\n"
+        "install:\n  - pip install .\n"
+        "jobs:\n  include:\n    - env: JOB=1\n    - env: JOB=2\n      cache: npm\n"
+    )
+    argv = ["travis2docker", "foo", "bar", "--no-clone", "--travis-yml-path", str(yml_path)]
+    argv += ["--root-path", str(tmp_path / "root")]
+
+    def read_script(script, fname):
+        with open(os.path.join(script, fname)) as f_script:
+            return f_script.read()
+
+    sys.argv = argv
+    scripts = main()
+    assert "--mount" not in read_script(scripts[0], "Dockerfile")
+    assert "DOCKER_BUILDKIT" not in read_script(scripts[0], "10-build.sh")
+
+    sys.argv = argv + ["--cache-mounts"]
+    scripts = main()
+    dockerfile = read_script(scripts[0], "Dockerfile")
+    assert dockerfile.startswith("# syntax=docker/dockerfile:1\n")
+    # Only apt is locked, the directories of the build directory are copied from and to the cache
+    node_modules = "/home/odoo/build/local_file/local_file/node_modules"
+    node_cache = "/tmp/t2d_cache/t2d_local_file_local_file_home_odoo_build_local_file_local_file_node_modules"
+    mounts = (
+        "--mount=type=cache,id=t2d_local_file_local_file_var_cache_apt,target=/var/cache/apt,sharing=locked,mode=0777 "
+        "--mount=type=cache,id=t2d_local_file_local_file_var_lib_apt_lists,target=/var/lib/apt/lists,"
+        "sharing=locked,mode=0777 "
+        "--mount=type=cache,id=t2d_local_file_local_file_home_odoo_.cache_pip,target=/home/odoo/.cache/pip,mode=0777 "
+        "--mount=type=cache,id=t2d_local_file_local_file_home_odoo_build_local_file_local_file_node_modules,"
+        "target=%s,mode=0777 " % node_cache
+    )
+    restore = "mkdir -p %s && cp -a %s/. %s && " % (node_modules, node_cache, node_modules)
+    assert 'RUN %s/bin/bash -c "%ssource' % (mounts, restore) in dockerfile
+    assert (
+        '/install && find %s -mindepth 1 -delete && cp -a %s/. %s"\n'
+        % (
+            node_cache,
+            node_modules,
+            node_cache,
+        )
+        in dockerfile
+    )
+    assert "export DOCKER_BUILDKIT=1\n" in read_script(scripts[0], "10-build.sh")
+    assert "docker run -itP -e LANG=C.UTF-8 -v t2d_local_file_local_file_var_cache_apt:/var/cache/apt " in read_script(
+        scripts[0], "20-run.sh"
+    )
+    assert "node_modules" not in read_script(scripts[0], "20-run.sh")
+    # The cache of the job replaces the global one
+    assert "-v t2d_local_file_local_file_home_odoo_.npm:/home/odoo/.npm $1" in read_script(scripts[1], "20-run.sh")
+
+
+def test_main_multi_stage(tmp_path, capsys):
+    yml_path = tmp_path / "travis.yml"
+    yml_path.write_text(
+        "language: python\npython:\n  - '3.8'\nenv:\n  - TESTS=1\n  - LINT=1\n"
+        "addons:\n  apt:\n    packages:\n      - unzip\n"
+        "install:\n  - pip install .\nscript:\n  - pytest\n"
+        "jobs:\n  include:\n    - env: JOB=1\n    - env: JOB=1\n      script:\n        - flake8\n"
+    )
+    sys.argv = ["travis2docker", "foo", "bar", "--no-clone", "--travis-yml-path", str(yml_path)]
+    sys.argv += ["--root-path", str(tmp_path / "root"), "--multi-stage"]
+    scripts = main()
+    assert len(scripts) == 4
+    version_path = os.path.dirname(scripts[0])
+    with open(os.path.join(version_path, "Dockerfile")) as f_dockerfile:
+        steps = travis2docker.get_dockerfile_steps(f_dockerfile.read())
+    froms = [step for step in steps if step.startswith("FROM ")]
+    # A base for each env with its install steps and a thin stage for each job with its script
+    assert froms == [
+        "FROM vauxoo/odoo-80-image-shippable-auto AS base_1",
+        "FROM vauxoo/odoo-80-image-shippable-auto AS base_2",
+        "FROM base_1 AS env_1_job_1",
+        "FROM base_1 AS env_1_job_2",
+        "FROM base_2 AS env_2_job_1",
+        "FROM base_2 AS env_2_job_2",
+    ]
+    assert len([step for step in steps if step.startswith("RUN git init")]) == 2
+    base_2 = steps[steps.index(froms[1]) : steps.index(froms[2])]
+    assert "COPY --chown=odoo:odoo env_2_job_1/files/install /install" in base_2
+    assert base_2.index("ENV LINT=1 JOB=1") < base_2.index(
+        'RUN /bin/bash -c "source ${REPO_REQUIREMENTS}/virtualenv/python3.8/bin/activate && '
+        'source ${REPO_REQUIREMENTS}/virtualenv/nodejs/bin/activate && source /rvm_env.sh && /install"'
+    )
+    assert steps[steps.index(froms[3]) + 1 : steps.index(froms[4])] == [
+        "COPY --chown=odoo:odoo env_1_job_2/files/entrypoint.sh /entrypoint.sh",
+        "COPY --chown=odoo:odoo env_1_job_2/files/script /script",
+        "ENTRYPOINT /entrypoint.sh",
+    ]
+    with open(os.path.join(scripts[2], "10-build.sh")) as f_build:
+        build_content = f_build.read()
+    assert "export DOCKER_BUILDKIT=1\n" in build_content
+    assert build_content.endswith(" --target env_2_job_1 %s" % version_path)
+    with open(os.path.join(os.path.dirname(version_path), "build-all.sh")) as f_build_all:
+        assert "export DOCKER_BUILDKIT=1\n" in f_build_all.read()
+    # Each job keeps its own Dockerfile
+    assert os.path.isfile(os.path.join(scripts[2], "Dockerfile"))
+
+    # The stages of the jobs not selected are kept for their 10-build.sh
+    argv = list(sys.argv)
+    sys.argv += ["--only-env", "1"]
+    assert main() == scripts[:2]
+    with open(os.path.join(version_path, "Dockerfile")) as f_dockerfile:
+        assert [
+            step for step in travis2docker.get_dockerfile_steps(f_dockerfile.read()) if step.startswith("FROM ")
+        ] == froms
+
+    sys.argv = argv + ["--deployv"]
+    with pytest.raises(SystemExit):
+        main()
+    assert "--multi-stage is not supported by the Dockerfile of --deployv" in capsys.readouterr().err
+
+
+def test_main_build_all(tmp_path, monkeypatch):
+    yml_path = tmp_path / "travis.yml"
+    yml_path.write_text(
+        "language: python\npython:\n  - '3.8'\nenv:\n  - TESTS=1\n  - TESTS=0\n"
+        "install:\n  - pip install .\nscript:\n  - pytest\n"
+        "stages:\n  - lint\n  - name: test\n"
+        "jobs:\n  include:\n    - env: JOB=1\n      stage: test\n    - env: JOB=2\n    - env: JOB=3\n      stage: lint\n"
+    )
+    sys.argv = ["travis2docker", "foo", "bar", "--no-clone", "--travis-yml-path", str(yml_path)]
+    sys.argv += ["--root-path", str(tmp_path / "root"), "--multi-stage"]
+    scripts = main()
+    work_path = os.path.dirname(os.path.dirname(scripts[0]))
+
+    # A docker of the tests saving its calls, the build of the job 2 of the env 2 fails
+    bin_path = tmp_path / "bin"
+    bin_path.mkdir()
+    docker_path = bin_path / "docker"
+    docker_path.write_text('#!/bin/bash\necho "$@" >> %s\n[[ "$*" != *env_2_job_2* ]]\n' % (tmp_path / "docker.log"))
+    docker_path.chmod(0o755)
+    monkeypatch.setenv("PATH", "%s:%s" % (bin_path, os.environ["PATH"]))
+    build_all = subprocess.run([os.path.join(work_path, "build-all.sh"), "2"], check=False)
+    assert build_all.returncode == 1
+
+    with open(tmp_path / "docker.log") as f_log:
+        calls = [call.split(" --target ")[1].split()[0] for call in f_log.read().splitlines()]
+    # The bases first (a base for each env), then the stage lint and the stage test
+    assert sorted(calls[:6]) == ["base_%d" % count for count in range(1, 7)]
+    assert sorted(calls[6:8]) == ["env_1_job_3", "env_2_job_3"]
+    assert sorted(calls[8:]) == ["env_1_job_1", "env_1_job_2", "env_2_job_1", "env_2_job_2"]
+    with open(os.path.join(work_path, "build-summary.tsv")) as f_summary:
+        summary = [line.split("\t") for line in f_summary.read().splitlines()]
+    assert summary[0] == ["job", "stage", "status", "seconds"]
+    statuses = {job: (stage, status) for job, stage, status, _ in summary[1:]}
+    assert statuses == dict(
+        {"3_8/base_%d" % count: ("base", "0") for count in range(1, 7)},
+        **{
+            "3_8/env_1_job_3": ("lint", "0"),
+            "3_8/env_2_job_3": ("lint", "0"),
+            "3_8/env_1_job_1": ("test", "0"),
+            "3_8/env_1_job_2": ("test", "0"),
+            "3_8/env_2_job_1": ("test", "0"),
+            "3_8/env_2_job_2": ("test", "1"),
+        }
+    )
+    assert os.path.isfile(os.path.join(work_path, "build-logs", "3_8_env_2_job_2.log"))
+
+    # The jobs generated before are kept in build-all.sh with a selector
+    with open(os.path.join(work_path, "build-all.sh")) as f_build_all:
+        build_all_content = f_build_all.read()
+    sys.argv += ["--only-env", "1"]
+    assert len(main()) == 3
+    with open(os.path.join(work_path, "build-all.sh")) as f_build_all:
+        assert f_build_all.read() == build_all_content
+
+
+def test_main_dedup_jobs(tmp_path, monkeypatch):
+    yml_path = tmp_path / "travis.yml"
+    yml_path.write_text(
+        "language: python\npython:\n  - '3.8'\nenv:\n  - TESTS=1\n  - TESTS=1\n  - LINT=1\n"
+        "install:\n  - pip install .\n"
+        "jobs:\n  include:\n    - env: JOB=1\n      name: first\n    - env: JOB=1\n      name: second\n"
+    )
+    argv = ["travis2docker", "foo", "bar", "--no-clone", "--travis-yml-path", str(yml_path)]
+    argv += ["--root-path", str(tmp_path / "root")]
+    output = io.StringIO()
+    monkeypatch.setattr(cli, "stdout", output)
+    compute_job = Travis2Docker.compute_job
+    rendered = []
+
+    def count_compute_job(self, job, *args, **kwargs):
+        rendered.append(job[1:3])
+        return compute_job(self, job, *args, **kwargs)
+
+    monkeypatch.setattr(Travis2Docker, "compute_job", count_compute_job)
+    sys.argv = argv + ["--dedup-jobs"]
+    scripts = main()
+    assert len(scripts) == 6
+    # Each job is rendered once, the plans used to compare the jobs are written
+    assert len(rendered) == len(set(rendered)) == 6
+    version_path = os.path.dirname(scripts[0])
+    # The jobs with the same env are the same, the name of the job is not used
+    assert [os.path.islink(script) for script in scripts] == [False, True, True, True, False, True]
+    assert os.readlink(scripts[3]) == "env_1_job_1"
+    assert os.readlink(scripts[5]) == "env_3_job_1"
+    assert "6 jobs generated as 2 build contexts (collapse ratio 3.00)" in output.getvalue()
+    with open(os.path.join(scripts[3], "10-build.sh")) as f_build:
+        assert "export IMAGE=local_file-local_file:bar_3_8_1\n" in f_build.read()
+    with open(os.path.join(os.path.dirname(version_path), "build-all.sh")) as f_build_all:
+        assert "3_8/env_2_job_1" not in f_build_all.read()
+
+    # Without dedup each job has its own directory again
+    sys.argv = argv
+    scripts = main()
+    assert not any(os.path.islink(script) for script in scripts)
+    with open(os.path.join(scripts[3], "10-build.sh")) as f_build:
+        assert "export IMAGE=local_file-local_file:bar_3_8_2\n" in f_build.read()
+    with open(os.path.join(scripts[0], "10-build.sh")) as f_build:
+        assert "export IMAGE=local_file-local_file:bar_3_8_1\n" in f_build.read()
+
+    # The jobs are rendered by the processes of the pool
+    sys.argv = argv + ["--dedup-jobs", "--workers", "2"]
+    assert main() == scripts
+    assert [os.path.islink(script) for script in scripts] == [False, True, True, True, False, True]
+    assert os.readlink(scripts[5]) == "env_3_job_1"